@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Measure how fast a Pyseidon master turns client invocations into
+running workers, for a given amount of preloaded state.
+
+Boots a master holding a synthetic heap, then drives it with the C
+client: sequential round trips for latency, concurrent clients for
+throughput. Worker CPU and memory come from the master's stats socket.
+The same trivial workload is also run as a cold `python script.py` that
+has to build the heap itself. Results are printed as JSON:
+
+```
+make -C pyseidon/client
+python bench/bench_spawn.py --heap-mb 64 --heap-mb 1024 --output bench.json
+```
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.insert(0, root)
+
+CHUNK = 64 * 1024
+
+def build_heap(heap_mb):
+    # Touch every page, and spread it over many objects as a real
+    # preloaded dataset would be.
+    chunk = bytes(range(256)) * (CHUNK // 256)
+    return [bytearray(chunk) for _ in range(heap_mb * 1024 * 1024 // CHUNK)]
+
+def serve(args):
+    import pyseidon
+
+    heap = build_heap(args.heap_mb)
+
+    def handler():
+        pass
+
+    master = pyseidon.Pyseidon(path=args.sock)
+    master.run(handler, pool_size=args.pool_size, freeze_gc=args.freeze_gc, stats_path=args.stats_sock, report_memory=True)
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+def summarize(samples):
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 50),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'max': max(samples),
+    }
+
+def run_client(client, env):
+    start = time.monotonic()
+    subprocess.check_call([client], env=env, stdout=subprocess.DEVNULL)
+    return time.monotonic() - start
+
+def wait_for_socket(path, proc, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('Master exited during boot with status {}'.format(proc.returncode))
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(path)
+            s.close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('Master did not come up within {}s'.format(timeout))
+
+def fetch_stats(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    s.sendall(b'GET /stats HTTP/1.0\r\n\r\n')
+    data = b''
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    s.close()
+    return json.loads(data.split(b'\r\n\r\n', 1)[1].decode('utf-8'))
+
+def bench_master(args, heap_mb):
+    tmpdir = tempfile.mkdtemp(prefix='pyseidon-bench-')
+    sock = os.path.join(tmpdir, 'master.sock')
+    stats_sock = os.path.join(tmpdir, 'stats.sock')
+    env = dict(os.environ, POSEIDON_SOCK=sock)
+
+    cmd = [sys.executable, os.path.abspath(__file__), '--serve', '--sock', sock, '--stats-sock', stats_sock, '--heap-mb', str(heap_mb), '--pool-size', str(args.pool_size)]
+    if args.freeze_gc:
+        cmd.append('--freeze-gc')
+    boot_start = time.monotonic()
+    master = subprocess.Popen(cmd, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_socket(sock, master, args.boot_timeout)
+        boot = time.monotonic() - boot_start
+
+        for _ in range(args.warmup):
+            run_client(args.client, env)
+        latencies = [run_client(args.client, env) for _ in range(args.requests)]
+
+        done = []
+        lock = threading.Lock()
+
+        def drive(count):
+            for _ in range(count):
+                latency = run_client(args.client, env)
+                with lock:
+                    done.append(latency)
+
+        per_thread = max(1, args.requests // args.concurrency)
+        threads = [threading.Thread(target=drive, args=(per_thread,)) for _ in range(args.concurrency)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        # Let the last workers' reports land
+        time.sleep(0.2)
+        stats = fetch_stats(stats_sock)
+    finally:
+        master.terminate()
+        master.wait()
+
+    histograms = stats['histograms']
+    return {
+        'heap_mb': heap_mb,
+        'pool_size': args.pool_size,
+        'freeze_gc': args.freeze_gc,
+        'master_boot_seconds': boot,
+        'round_trip_seconds': summarize(latencies),
+        'concurrent': {
+            'concurrency': args.concurrency,
+            'requests': len(done),
+            'spawns_per_second': len(done) / elapsed,
+            'round_trip_seconds': summarize(done),
+        },
+        'master': {name: histograms.get(name) for name in ('handshake_seconds', 'fork_seconds', 'spawn_seconds', 'handler_start_seconds')},
+        'worker': {name: histograms.get(name) for name in ('worker_cpu_seconds', 'worker_maxrss_bytes', 'worker_shared_bytes', 'worker_private_bytes')},
+    }
+
+def bench_cold(args, heap_mb):
+    script = 'import sys; sys.path.insert(0, {!r}); import bench_spawn; heap = bench_spawn.build_heap({})'.format(here, heap_mb)
+    latencies = []
+    for _ in range(args.cold_runs):
+        start = time.monotonic()
+        subprocess.check_call([sys.executable, '-c', script])
+        latencies.append(time.monotonic() - start)
+    return {'heap_mb': heap_mb, 'round_trip_seconds': summarize(latencies)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--heap-mb', type=int, action='append', help='Size of the preloaded heap; may be repeated (default: 0, 256)')
+    parser.add_argument('--requests', type=int, default=200, help='Round trips to time per heap size')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients for the throughput run')
+    parser.add_argument('--cold-runs', type=int, default=3, help='Cold `python` starts to time per heap size; 0 to skip')
+    parser.add_argument('--pool-size', type=int, default=0)
+    parser.add_argument('--freeze-gc', action='store_true')
+    parser.add_argument('--client', default=os.path.join(root, 'pyseidon', 'client', 'pyseidon'))
+    parser.add_argument('--boot-timeout', type=float, default=600)
+    parser.add_argument('--output', help='Write JSON here instead of stdout')
+    # Internal: run as the master
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--sock', help=argparse.SUPPRESS)
+    parser.add_argument('--stats-sock', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        args.heap_mb = args.heap_mb[0]
+        return serve(args)
+
+    results = {
+        'python': sys.version,
+        'platform': sys.platform,
+        'cpus': os.cpu_count(),
+        'pyseidon': [],
+        'cold': [],
+    }
+    for heap_mb in args.heap_mb or [0, 256]:
+        print('Benchmarking {}MB heap...'.format(heap_mb), file=sys.stderr)
+        results['pyseidon'].append(bench_master(args, heap_mb))
+        if args.cold_runs:
+            results['cold'].append(bench_cold(args, heap_mb))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,579 @@
 import array
 import atexit
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
 import errno
 import fcntl
+import functools
+import gc
+import heapq
+import hmac
+import importlib
+import json
 import _multiprocessing
 import os
+import pickle
+import pstats
+import resource
 import select
+import selectors
 import signal
 import socket
 import struct
 import sys
+import sysconfig
+import tempfile
+import threading
+import time
+import traceback
 
-# Read a line up to a custom delimiter
-def _recvline(io, delim=b'\n'):
-    buf = []
-    while True:
-        byte = io.recv(1)
-        buf.append(byte)
+import pyseidon.imports
+import pyseidon.inprocess
+import pyseidon.parallel
+from pyseidon.inprocess import in_process
+from pyseidon.parallel import map
+from pyseidon.stats import Stats, MEMORY_BUCKETS
+
+# Ancillary buffer size for receiving FDs; plenty for the handful a
+# client sends.
+_ANCBUFSIZE = 4096
+_RECVSIZE = 65536
+# Workers split reports bigger than this over several datagrams, so
+# each fits in _RECVSIZE
+_MAX_REPORT = 32768
+
+class ProtocolError(RuntimeError):
+    pass
 
-        # End of line reached!
-        if byte == b'' or byte == delim:
-            return b''.join(buf)
+class UnsupportedProtocol(ProtocolError):
+    # The client speaks a version we don't; it's told which ones we do
+    # before we hang up
+    pass
 
-def _recvfds(sock):
-    msg, anc, flags, addr = sock.recvmsg(1, 4096)
+def _recvmsg(sock, bufsize=_RECVSIZE):
+    msg, anc, flags, addr = sock.recvmsg(bufsize, _ANCBUFSIZE)
     fds = []
     for level, type, data in anc:
-        fda = array.array('I')
-        fda.frombytes(data)
-        fds.extend(fda)
-    return fds
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fda = array.array('i')
+            fda.frombytes(data[:len(data) - (len(data) % fda.itemsize)])
+            fds.extend(fda)
+    if flags & socket.MSG_CTRUNC:
+        for fd in fds:
+            os.close(fd)
+        raise ProtocolError('Ancillary data was truncated; client sent too many FDs')
+    if flags & socket.MSG_TRUNC:
+        # Only datagrams; the rest of it is gone
+        for fd in fds:
+            os.close(fd)
+        raise ProtocolError('Message was truncated')
+    return msg, fds
+
+# Protocol v2 requests start with this magic (which, read as a v1
+# argc, would be absurdly large), followed by the version, reserved
+# flags and the payload length.
+PROTOCOL_MAGIC = b'PSDN'
+PROTOCOL_VERSION = 2
+_V2_HEADER = struct.Struct('<4sHHI')
+# A request in a version we don't speak is answered with a v2 result
+# of this status, followed by a supported=<versions> string, so the
+# client can tell it from a crash
+UNSUPPORTED_PROTOCOL_STATUS = 101
+SUPPORTED_VERSIONS = (1, 2)
+# Refuse to buffer more than this for a single request
+_MAX_PAYLOAD = 64 * 1024 * 1024
+# Likewise for a request on the stats socket
+_MAX_CONTROL_REQUEST = 8192
+# TCP clients present their token before anything else, and until
+# they have, we hold this little of theirs. There can only be so many
+# such clients at once, and only for so long.
+_MAX_TOKEN = 1024
+_MAX_TCP_HANDSHAKES = 64
+_TCP_HANDSHAKE_TIMEOUT = 10
+# How often to re-check memory while admission is held up on it
+_ADMISSION_RETRY = 0.1
+# Functions listed when a profile is printed back to the client
+_CPROFILE_LINES = 30
+# TCP clients' stdio goes over their connection as frames: a type (the
+# stream's FD number, or _FRAME_EXIT for the result) and a length
+_STREAM_FRAME = struct.Struct('<BI')
+_FRAME_EXIT = 3
+# How much to read at a time (and the most a client may send in one
+# frame), and how much to hold for a slow reader (in either direction)
+# before we stop reading from the other side
+_STREAM_CHUNK = 256 * 1024
+_STREAM_HIGH_WATER = 4 * 1024 * 1024
+
+# Per-job limits, by what clients and run() call them: the rlimit each
+# sets. There's also wall, in seconds, which we enforce ourselves.
+_RLIMITS = {
+    'cpu': resource.RLIMIT_CPU,
+    'memory': resource.RLIMIT_AS,
+    'files': resource.RLIMIT_NOFILE,
+}
+_LIMITS = ['cpu', 'wall', 'memory', 'files']
+# What a v2 result carries after the exit status, for a worker that
+# ran: the signal that killed it (or 0), its wall and CPU seconds, and
+# its peak RSS in bytes
+_RESULT_USAGE = struct.Struct('<iddQ')
+
+def _pack_result(version, status, usage=None):
+    if version == 1:
+        return struct.pack('<i', status)
+    # v2 results are length-prefixed, so fields can be appended later
+    # without confusing older clients.
+    payload = struct.pack('<i', status)
+    if usage is not None:
+        payload += _RESULT_USAGE.pack(*usage)
+    return struct.pack('<I', len(payload)) + payload
+
+def _maxrss_bytes(rusage):
+    # ru_maxrss is in kB, except on macOS
+    return rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+
+def _parse_limit(name, value):
+    # None unless it's a usable limit: positive and finite, and whole
+    # for all but wall
+    try:
+        value = float(value) if name == 'wall' else int(value)
+    except (TypeError, ValueError):
+        return None
+    # NaN fails this too
+    if not 0 < value < float('inf'):
+        return None
+    return value
+
+def _lower_rlimit(which, value):
+    _, hard = resource.getrlimit(which)
+    if hard != resource.RLIM_INFINITY and value >= hard:
+        # Can't raise it anyway
+        resource.setrlimit(which, (hard, hard))
+        return
+    # A second's headroom over the soft CPU limit, so the worker is
+    # sent SIGXCPU before it's killed outright
+    resource.setrlimit(which, (value, value + 1 if which == resource.RLIMIT_CPU else value))
+
+def _pack_job_result(job, result):
+    # On a multiplexed connection, a v2 result is framed with its job's
+    # id after the length. Job 0 means the master is retiring the
+    # connection: it reads no further requests, and hangs up once it's
+    # answered the ones it has.
+    return struct.pack('<IQ', len(result) - 4 + 8, job) + result[4:]
+
+def _memory_usage():
+    # Returns kB figures from /proc/self/smaps_rollup, or None where
+    # that isn't available (non-Linux, kernels before 4.14).
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return None
+    fields = {}
+    for line in lines[1:]:
+        parts = line.split()
+        if len(parts) >= 2 and parts[0].endswith(':'):
+            fields[parts[0][:-1]] = int(parts[1])
+    return {
+        'rss': fields.get('Rss', 0),
+        'pss': fields.get('Pss', 0),
+        'shared': fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0),
+        'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0),
+    }
+
+def _available_memory():
+    # Bytes the kernel thinks can be allocated without swapping, or
+    # None where /proc/meminfo isn't available.
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+def _tee(source, target, captured, limit):
+    # Copy everything from source to target, keeping up to limit bytes
+    # of it. captured[0] is set to None once the limit is blown.
+    while True:
+        data = os.read(source, 65536)
+        if not data:
+            break
+        if target is not None:
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(target, view):]
+            except OSError:
+                # Client went away; keep draining so the writer
+                # doesn't block.
+                target = None
+        if captured[0] is not None:
+            if len(captured[0]) + len(data) > limit:
+                captured[0] = None
+            else:
+                captured[0] += data
+    os.close(source)
+
+def _pidfd_supported():
+    if not hasattr(os, 'pidfd_open'):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        # Kernels before 5.3
+        return False
+    return True
+
+def _send_handoff(channel, request, fds):
+    # Hand a fully-received request to an already-running worker
+    data = pickle.dumps(request, pickle.HIGHEST_PROTOCOL)
+    data = struct.pack('<I', len(data)) + data
+    sent = channel.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    if sent < len(data):
+        channel.sendall(data[sent:])
+
+def _recv_handoff(channel):
+    buf = bytearray()
+    fds = []
+    length = None
+    while length is None or len(buf) < length + 4:
+        data, new_fds = _recvmsg(channel)
+        fds.extend(new_fds)
+        if not data:
+            # Master went away before giving us anything to do
+            return None, fds
+        buf += data
+        if length is None and len(buf) >= 4:
+            length, = struct.unpack_from('<I', buf)
+    return pickle.loads(bytes(buf[4:])), fds
+
+def _watched_modules(watch):
+    # watch=True means everything preloaded from outside the standard
+    # library and site-packages: in practice, the application's own
+    # code.
+    if watch is not True:
+        return list(watch)
+    paths = sysconfig.get_paths()
+    skip = [os.path.join(paths[key], '') for key in ('stdlib', 'platstdlib', 'purelib', 'platlib')]
+    names = []
+    for name, module in list(sys.modules.items()):
+        # __main__ is still running, and pyseidon is running it
+        if name == '__main__' or name.split('.')[0] == 'pyseidon':
+            continue
+        path = getattr(module, '__file__', None)
+        # Extension modules can't be reloaded
+        if not path or not path.endswith('.py'):
+            continue
+        path = os.path.abspath(path)
+        if any(path.startswith(prefix) for prefix in skip):
+            continue
+        names.append(name)
+    return names
+
+def _module_mtimes(names):
+    mtimes = {}
+    for name in names:
+        try:
+            mtimes[name] = os.stat(sys.modules[name].__file__).st_mtime_ns
+        except (OSError, KeyError):
+            mtimes[name] = None
+    return mtimes
+
+def _resolve(obj):
+    # Find the current version of a function or class by name, after
+    # its module has been reloaded. Closures can't be found this way
+    # and are kept as they are.
+    target = sys.modules.get(getattr(obj, '__module__', None))
+    for part in getattr(obj, '__qualname__', '<locals>').split('.'):
+        target = getattr(target, part, None)
+    return target if target is not None else obj
 
-def _recvfd(sock):
-    fds = _recvfds(sock)
-    assert len(fds) == 1, 'Expected exactly one FD, but got: {}'.format(fds)
-    return fds[0]
+class _Handshake(object):
+    """Incrementally parse a client's request as bytes and FDs trickle in.
+
+    Two wire formats are understood. Counts are 4-byte little-endian
+    ints and strings are NUL-terminated.
+
+    v1: argc, argv, envc, env (as k=v), cwd, and then stdin, stdout,
+    stderr, each sent as a single byte carrying one FD.
+
+    v2: a header (magic, version, flags, payload length), then a
+    payload of argc, argv, envc, env, cwd and any number of trailing
+    k=v option strings. All three FDs ride along with the first byte of
+    the header, so the whole request is usually a single sendmsg.
+
+    A v2 request with a job option multiplexes the connection: further
+    requests may follow it, and whatever of them has already arrived
+    is left in buf and fds for the next handshake.
+
+    Over TCP, requests are v2 without FDs, preceded by the length of
+    the client's token and the token itself, which must match
+    tcp_token. Whatever follows them (the client's stdin) is left in
+    buf.
+    """
+    def __init__(self, conn, tcp_token=None):
+        self.conn = conn
+        self.tcp = tcp_token is not None
+        self.tcp_token = tcp_token
+        self.nfds = 0 if self.tcp else 3
+        self.accepted_at = time.monotonic()
+        self.buf = bytearray()
+        self.pos = 0
+        self.fds = []
+        self.state = 'token' if self.tcp else 'magic'
+        self.version = None
+        self.length = 0
+        self.remaining = 0
+        self.argv = []
+        self.env = {}
+        self.cwd = None
+        self.options = {}
+        # What the job's worker may use; see _job_limits
+        self.limits = {}
+        # Set by the master when this invocation's output should be
+        # captured for the result cache
+        self.cache_key = None
+        self.capture = None
+
+    def feed(self, data, fds):
+        self.buf += data
+        self.fds.extend(fds)
+        while self.state != 'done' and self._step():
+            pass
+        # Drop what we've consumed so the buffer doesn't grow
+        # without bound on large environments.
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        if self.state == 'done' and len(self.buf) and 'job' not in self.options and not self.tcp:
+            raise ProtocolError('Client sent unexpected trailing data: {!r}'.format(bytes(self.buf[:256])))
+        return self.state == 'done'
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        if self.capture is not None:
+            self.capture.close()
+        self.conn.close()
+
+    def _read_int(self):
+        if len(self.buf) - self.pos < 4:
+            return None
+        value, = struct.unpack_from('<I', self.buf, self.pos)
+        self.pos += 4
+        return value
+
+    def _read_string(self, limit=None):
+        end = self.buf.find(b'\0', self.pos, limit)
+        if end < 0:
+            return None
+        value = bytes(self.buf[self.pos:end])
+        self.pos = end + 1
+        return value
+
+    def _add_env(self, value):
+        if b'=' not in value:
+            raise ProtocolError('Corrupted env entry; missing "=": {!r}'.format(value))
+        k, v = value.split(b'=', 1)
+        self.env[k] = v
+
+    def _check_fds(self):
+        if len(self.fds) > 3:
+            raise ProtocolError('Expected exactly three FDs, but got: {}'.format(self.fds))
+        return len(self.fds) == 3
+
+    def _step(self):
+        if self.state == 'token':
+            if len(self.buf) - self.pos < 4:
+                return False
+            length, = struct.unpack_from('<I', self.buf, self.pos)
+            if length > _MAX_TOKEN:
+                raise ProtocolError('Token too long: {} bytes'.format(length))
+            if len(self.buf) - self.pos < 4 + length:
+                return False
+            token = bytes(self.buf[self.pos + 4:self.pos + 4 + length])
+            self.pos += 4 + length
+            if not hmac.compare_digest(token, self.tcp_token):
+                raise ProtocolError('Bad token')
+            self.state = 'magic'
+        elif self.state == 'magic':
+            if len(self.buf) - self.pos < 4:
+                return False
+            if self.buf[self.pos:self.pos + 4] == PROTOCOL_MAGIC:
+                self.state = 'header'
+            elif self.tcp:
+                raise UnsupportedProtocol('TCP clients must speak protocol v2')
+            else:
+                self.version = 1
+                self.state = 'argc'
+        elif self.state == 'header':
+            if len(self.buf) - self.pos < _V2_HEADER.size:
+                return False
+            _, self.version, _, self.length = _V2_HEADER.unpack_from(self.buf, self.pos)
+            self.pos += _V2_HEADER.size
+            if self.version != PROTOCOL_VERSION:
+                raise UnsupportedProtocol('Unsupported protocol version: {}'.format(self.version))
+            if self.length > _MAX_PAYLOAD:
+                raise ProtocolError('Request too large: {} bytes'.format(self.length))
+            self.state = 'payload'
+        elif self.state == 'payload':
+            if len(self.buf) - self.pos < self.length:
+                # A later request's FDs can't arrive before all of this
+                # one has
+                self._check_fds()
+                return False
+            if len(self.fds) < self.nfds:
+                return False
+            self._parse_payload(self.pos + self.length)
+            if len(self.fds) > 3 and 'job' not in self.options:
+                raise ProtocolError('Expected exactly three FDs, but got: {}'.format(self.fds))
+            if self.tcp and 'job' in self.options:
+                raise ProtocolError('Jobs cannot be multiplexed over TCP')
+            self.state = 'done'
+        elif self.state in ('argc', 'envc'):
+            count = self._read_int()
+            if count is None:
+                return False
+            self.remaining = count
+            self.state = 'argv' if self.state == 'argc' else 'env'
+        elif self.state in ('argv', 'env'):
+            if self.remaining == 0:
+                self.state = 'envc' if self.state == 'argv' else 'cwd'
+                return True
+            value = self._read_string()
+            if value is None:
+                return False
+            if self.state == 'argv':
+                self.argv.append(value)
+            else:
+                self._add_env(value)
+            self.remaining -= 1
+        elif self.state == 'cwd':
+            self.cwd = self._read_string()
+            if self.cwd is None:
+                return False
+            self.state = 'fds'
+        elif self.state == 'fds':
+            # Each FD rides along with one dummy byte
+            if len(self.buf) - self.pos < 3 or not self._check_fds():
+                return False
+            self.pos += 3
+            self.state = 'done'
+        return True
+
+    def _parse_payload(self, end):
+        def read_int():
+            if end - self.pos < 4:
+                raise ProtocolError('Truncated request payload')
+            return self._read_int()
+
+        def read_string():
+            value = self._read_string(end)
+            if value is None:
+                raise ProtocolError('Truncated request payload')
+            return value
+
+        self.argv = [read_string() for _ in range(read_int())]
+        for _ in range(read_int()):
+            self._add_env(read_string())
+        self.cwd = read_string()
+        while self.pos < end:
+            option = read_string()
+            k, _, v = option.partition(b'=')
+            self.options[k.decode('utf-8', 'replace')] = v.decode('utf-8', 'replace')
 
 class Pyseidon(object):
     def __init__(self, path='/tmp/pyseidon.sock'):
         self.path = path
+        self.sock = None
+        self.control_sock = None
+        self.tcp_sock = None
+        self.tcp_token = None
+        self.use_pidfd = False
+        self.pool_size = 0
+        self.freeze_gc = False
+        self.max_workers = None
+        self.min_available_memory = None
+        self.report_memory = False
+        self.cache = None
+        # Ceilings on each job's limits; see run()
+        self.limits = {}
+        # Worker-side state for capturing output into the cache
+        self.capture = None
+        # Worker-side: where to put the handler's profile, and how long
+        # its request took to get this far, if the client asked for one
+        self.cprofile = None
+        self.import_profile = None
+        # Handler and thread pool, when serving requests in-process
+        self.in_process = None
+        # The asyncio event loop, with serve_async
+        self.loop = None
+        self.async_callback = None
+        self.async_tick = None
+        # Child masters serving named profiles, by name. See
+        # add_profile.
+        self.profiles = {}
+        # The profile this master serves, or None in the base master
+        self.profile = None
+        self.profile_channel = None
+        # With reload, our link to the zygote, which closes it once a
+        # newer generation is serving
+        self.generation = None
+        self.generation_channel = None
+        self.generation_ready = False
+        # What to do with each type of report from workers
+        self.report_handlers = {
+            'start': self._on_worker_start,
+            'memory': self._on_worker_memory,
+            'profile_ready': self._on_profile_ready,
+            'imports': self._on_worker_imports,
+            'map': self._on_map,
+        }
+        self._init_master_state()
+
+    def _init_master_state(self):
+        # Everything that belongs to one running master. A profile's
+        # master starts over with a fresh copy.
         self.children = {}
+        # pidfds for children we're watching, by pid. Without pidfd
+        # support we fall back to SIGCHLD plus waitpid(-1).
+        self.pidfds = {}
+        # Result messages that didn't fit in the socket buffer, by conn
+        self.outgoing = {}
+        self.handshakes = {}
+        # TCP clients' handshakes, oldest first
+        self.tcp_handshakes = collections.OrderedDict()
+        # Idle pre-forked workers, by pid
+        self.pool = {}
+        # Admission control: completed handshakes wait here (as a
+        # heap of (-priority, seq, entry)) while we're at capacity.
+        self.queue = []
+        self.queue_seq = 0
+        # When workers with a wall limit are due to be killed, as a
+        # heap of (deadline, pid)
+        self.deadlines = []
+        # Work put off until there's nothing else to do (see defer())
+        self.idle_tasks = collections.deque()
+        self.stats = Stats()
+        self.control_conns = {}
+        # Multiplexed connections, by conn
+        self.muxes = {}
+        # TCP clients' connections, by conn
+        self.streams = {}
+        # Siblings forked for pyseidon.map: the worker each is for, by
+        # pid
+        self.siblings = {}
+        # Cache hits still writing out their output
+        self.replaying = 0
+        # In-process requests still running, and those done but not yet
+        # answered (appended to from the executor's threads)
+        self.in_process_running = 0
+        self.in_process_results = collections.deque()
+        self.draining = False
         self.master_pid = os.getpid()
 
         r, w = os.pipe()
@@ -49,48 +584,403 @@ class Pyseidon(object):
         self.loopbreak_reader = os.fdopen(r, 'rb', 0)
         self.loopbreak_writer = os.fdopen(w, 'wb', 0)
 
+        self.selector = selectors.DefaultSelector()
+        self._add_reader(self.loopbreak_reader, self._drain_loopbreak)
+
+        # Workers report back (handler start, memory usage, ...) as
+        # JSON datagrams. Datagrams can't interleave, and a worker
+        # never blocks on them.
+        self.report_reader, self.report_writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.report_reader.setblocking(False)
+        self.report_writer.setblocking(False)
+        self._add_reader(self.report_reader, self._read_reports)
+
+    def add_profile(self, name, setup=None, handler=None, path=None):
+        """Serve a named profile from its own child master.
+
+        When run() starts, it forks a master per profile. That master
+        calls setup() to preload whatever only this profile needs, on
+        top of what's already loaded here, which stays shared with
+        every other profile. Its workers run handler (by default, the
+        callback passed to run()).
+
+        Clients pick a profile by setting POSEIDON_PROFILE (or the
+        profile option of protocol v2) when talking to this master's
+        socket, or, given a path, by pointing POSEIDON_SOCK at the
+        profile's own socket.
+        """
+        if name in self.profiles:
+            raise KeyError('Profile already registered: {}'.format(name))
+        self.profiles[name] = {
+            'name': name,
+            'setup': setup,
+            'handler': handler,
+            'path': path,
+            'sock': None,
+            'pid': None,
+            'ready': False,
+            'channel': None,
+            # Routed clients not yet (fully) handed to its master
+            'backlog': collections.deque(),
+            'writing': False,
+        }
+
     def _run_event_loop(self):
         while True:
-            conns = {}
-            for child in self.children.values():
-                if not child['notified']:
-                    conns[child['conn']] = child
+            # Registrations persist across iterations, so each wakeup
+            # only costs as much as the number of ready FDs.
+            events = self.selector.select(self._loop_timeout())
+            for key, _ in events:
+                # An earlier callback in this batch may have
+                # unregistered (and closed) this FD.
+                if self.selector.get_map().get(key.fd) is not key:
+                    continue
+                argv = key.data(key.fileobj)
+                # In the master, we'll just hit another cycle through
+                # the loop.
+                if not self._is_master():
+                    return argv
+
+            argv = self._after_events()
+            if not self._is_master():
+                return argv
+            if not events:
+                self._run_idle_task()
+
+    def defer(self, task):
+        """Call task() in the master once it has nothing else to do: not
+        from within handling an event, and never while clients are
+        waiting on it. Tasks run one per pass through the event loop, so
+        each should be short; split long work into several."""
+        self.idle_tasks.append(task)
+
+    def _run_idle_task(self):
+        if not self.idle_tasks:
+            return
+        task = self.idle_tasks.popleft()
+        try:
+            task()
+        except Exception:
+            print('[{}] Deferred task failed:'.format(os.getpid()), file=sys.stderr)
+            traceback.print_exc()
 
+    def _after_events(self):
+        self._kill_overdue()
+        self._expire_tcp_handshakes()
+        # Workers may have exited, or memory freed up
+        argv = self._dispatch_queued()
+        if not self._is_master():
+            return argv
+        if self.draining:
+            self._check_drained()
+
+        # Refill the pool one fork at a time, between batches of
+        # events, so new clients are never kept waiting on it.
+        if len(self.pool) < self.pool_size and self._memory_ok():
+            return self._refill_pool()
+
+    def _loop_timeout(self):
+        if len(self.pool) < self.pool_size and self._memory_ok():
+            return 0
+        if self.idle_tasks:
+            # Poll, and run the next one if nothing turns up
+            return 0
+        timeout = None
+        if self.queue and self.min_available_memory is not None:
+            # Nothing will wake us up when memory frees up
+            timeout = _ADMISSION_RETRY
+        deadlines = []
+        if self.deadlines:
+            deadlines.append(self.deadlines[0][0])
+        if self.tcp_handshakes:
+            deadlines.append(next(iter(self.tcp_handshakes.values())).accepted_at + _TCP_HANDSHAKE_TIMEOUT)
+        if deadlines:
+            until = max(0, min(deadlines) - time.monotonic())
+            timeout = until if timeout is None else min(timeout, until)
+        return timeout
+
+    def _kill_overdue(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, pid = heapq.heappop(self.deadlines)
+            # A worker, or a sibling it forked for pyseidon.map
+            child = self.children.get(pid, self.siblings.get(pid))
+            # Long gone, or the pid's since been reused
+            if child is None or child['deadline'] != deadline:
+                continue
+            print('[{}] Process {} exceeded its wall-clock limit of {}s; killing it'.format(os.getpid(), pid, child['wall_limit']), file=sys.stderr)
             try:
-                # We want to detect when a client has hung up (so we
-                # can tell the child about this). See
-                # http://stefan.buettcher.org/cs/conn_closed.html for
-                # another way of solving this problem with poll(2).
-                candidates = [self.loopbreak_reader, self.sock] + list(conns.keys())
-                readers, _, _ = select.select(candidates, [], [])
-            except select.error as e:
-                if e.errno == errno.EINTR:
-                    # Probably just got a SIGCHLD. We'll forfeit this run
-                    # through the loop.
-                    continue
-                else:
-                    raise
-
-            for reader in readers:
-                if reader == self.loopbreak_reader:
-                    # Drain the loopbreak reader
-                    self.loopbreak_reader.read()
-                    self._reap()
-                elif reader == self.sock:
-                    argv = self._accept()
-                    # In the master, we'll just hit another cycle through
-                    # the loop.
-                    if not self._is_master():
-                        return argv
-                elif reader in conns:
-                    child = conns[reader]
-                    data = self._socket_peek(reader)
-                    if len(data) == 0:
-                        self._notify_socket_dead(child)
-                    elif data is None:
-                        raise RuntimeError('Socket unexpectedly showed up in readers list, but has nothing to read: child={}'.format(child['pid']))
-                    else:
-                        raise RuntimeError('Socket unexpectedly had available data: child={} data={}'.format(child['pid'], data))
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def _expire_tcp_handshakes(self):
+        now = time.monotonic()
+        while self.tcp_handshakes:
+            handshake = next(iter(self.tcp_handshakes.values()))
+            if now - handshake.accepted_at < _TCP_HANDSHAKE_TIMEOUT:
+                break
+            print('[{}] Dropping TCP client that took over {}s to send its request'.format(os.getpid(), _TCP_HANDSHAKE_TIMEOUT), file=sys.stderr)
+            self._drop_handshake(handshake)
+
+    def _add_reader(self, fileobj, callback):
+        if self.loop is not None:
+            self.loop.add_reader(fileobj, self._run_async_callback, callback, fileobj)
+        else:
+            self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def _remove_reader(self, fileobj):
+        if self.loop is not None:
+            self.loop.remove_reader(fileobj)
+        else:
+            self.selector.unregister(fileobj)
+
+    def _add_writer(self, fileobj, callback):
+        if self.loop is not None:
+            self.loop.add_writer(fileobj, self._run_async_callback, callback, fileobj)
+        else:
+            self.selector.register(fileobj, selectors.EVENT_WRITE, callback)
+
+    def _remove_writer(self, fileobj):
+        if self.loop is not None:
+            self.loop.remove_writer(fileobj)
+        else:
+            self.selector.unregister(fileobj)
+
+    def _run_async_callback(self, callback, fileobj):
+        callback(fileobj)
+        self._after_async()
+
+    def _after_async(self):
+        # The asyncio counterpart of the end of a pass through
+        # _run_event_loop
+        if self._is_master():
+            self._after_events()
+        if not self._is_master():
+            self._serve_async_worker()
+        timeout = self._loop_timeout()
+        if timeout is None:
+            return
+        if self.async_tick is not None and self.async_tick.when() > self.loop.time() + timeout:
+            # Say, a wall limit due sooner than the tick we've got
+            self.async_tick.cancel()
+            self.async_tick = None
+        if self.async_tick is None:
+            self.async_tick = self.loop.call_later(timeout, self._async_tick)
+
+    def _async_tick(self):
+        self.async_tick = None
+        if self._is_master():
+            self._run_idle_task()
+        self._after_async()
+
+    def _adopt_loop(self, loop):
+        # Move what's been registered with our own selector so far over
+        # to the asyncio loop
+        registered = list(self.selector.get_map().values())
+        for key in registered:
+            self.selector.unregister(key.fileobj)
+        self.loop = loop
+        for key in registered:
+            if key.events & selectors.EVENT_READ:
+                self._add_reader(key.fileobj, key.data)
+            else:
+                self._add_writer(key.fileobj, key.data)
+
+    def _reap_known(self):
+        # Without pidfds under asyncio: the application may have
+        # children of its own, so only ever wait on ours.
+        for pid in list(self.children) + list(self.pool) + list(self.siblings):
+            try:
+                reaped, exitinfo, rusage = os.wait4(pid, os.WNOHANG)
+            except ChildProcessError:
+                continue
+            if reaped:
+                self._handle_exit(pid, exitinfo, rusage)
+        self._after_async()
+
+    def _serve_async_worker(self):
+        # Forked from inside the application's event loop, which we
+        # mustn't ever go back to: its other tasks belong to the master.
+        # Run the handler and exit right here.
+        self.loop = None
+        try:
+            signal.set_wakeup_fd(-1)
+        except ValueError:
+            # Not the main thread
+            pass
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        status = 0
+        try:
+            self._serve_worker(self.async_callback)
+        except SystemExit as e:
+            if e.code is not None and not isinstance(e.code, int):
+                print(e.code, file=sys.stderr)
+            status = self._exit_status(e.code)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except Exception:
+                    pass
+            os._exit(status)
+
+    def _drain_loopbreak(self, reader):
+        self.loopbreak_reader.read()
+        if not self.use_pidfd and self.loop is None:
+            self._reap()
+        while self.in_process_results:
+            self._finish_in_process(*self.in_process_results.popleft())
+
+    def _report(self, message, fds=()):
+        # Worker side
+        try:
+            data = json.dumps(message).encode('utf-8')
+            if fds:
+                self.report_writer.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+            else:
+                self.report_writer.send(data)
+        except socket.error as e:
+            # Purely informational; drop it if the master is behind
+            print('[{}] Could not report to master: {}'.format(os.getpid(), e), file=sys.stderr)
+
+    def _report_imports(self, modules):
+        # Worker side. Only the ones worth preloading, a datagram's
+        # worth at a time.
+        batch, size = {}, 0
+        for name, seconds in modules.items():
+            if seconds < self.import_profile.min_seconds:
+                continue
+            # The name, quoted, plus the time and separators
+            entry = len(json.dumps(name)) + 32
+            if batch and size + entry > _MAX_REPORT:
+                self._report({'type': 'imports', 'modules': batch})
+                batch, size = {}, 0
+            batch[name] = seconds
+            size += entry
+        if batch:
+            self._report({'type': 'imports', 'modules': batch})
+
+    def _read_reports(self, reader):
+        while True:
+            try:
+                data, fds = _recvmsg(reader)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ProtocolError as e:
+                print('[{}] Dropping report from worker: {}'.format(os.getpid(), e), file=sys.stderr)
+                continue
+            try:
+                message = json.loads(data.decode('utf-8'))
+                if not isinstance(message, dict):
+                    raise ValueError('not an object')
+            except ValueError as e:
+                # A worker's bug shouldn't take the master down
+                print('[{}] Dropping malformed report from worker: {}'.format(os.getpid(), e), file=sys.stderr)
+                for fd in fds:
+                    os.close(fd)
+                continue
+            handler = self.report_handlers.get(message.get('type'))
+            if handler is None:
+                print('[{}] Ignoring unknown report from worker: {}'.format(os.getpid(), message), file=sys.stderr)
+                for fd in fds:
+                    os.close(fd)
+            else:
+                if fds:
+                    message['fds'] = fds
+                handler(message)
+
+    def _on_worker_start(self, message):
+        child = self.children.get(message['pid'])
+        if child is None:
+            return
+        child['started_at'] = message['time']
+        self.stats.observe('handler_start_seconds', message['time'] - child['accepted_at'])
+
+    def _on_worker_memory(self, message):
+        print('[{}] Worker {} memory: rss={rss}kB pss={pss}kB shared={shared}kB private={private}kB'.format(os.getpid(), message['pid'], **message['usage']), file=sys.stderr)
+        for field in ('shared', 'private'):
+            self.stats.observe('worker_{}_bytes'.format(field), message['usage'][field] * 1024, buckets=MEMORY_BUCKETS)
+
+    def _on_worker_imports(self, message):
+        if self.import_profile is not None and message['modules']:
+            self.import_profile.record(message['modules'])
+
+    def _on_map(self, message):
+        # A worker wants siblings for pyseidon.map: one per channel it
+        # sent along with its stdout and stderr. They count against
+        # max_workers like anything else; it finds out which channels
+        # we didn't fork for when we close them.
+        fds = message.get('fds', [])
+        stdio, channels = fds[:2], fds[2:]
+        room = self._room()
+        if room is not None:
+            channels = channels[:room]
+        # Siblings are held to the limits and deadline of the job they
+        # work for
+        parent = self.children.get(message['pid'], self.siblings.get(message['pid']))
+        limits = parent['limits'] if parent is not None else {}
+        for channel in channels:
+            pid = self._fork()
+            if pid:
+                sibling = self.siblings[pid] = {
+                    'worker': message['pid'],
+                    'limits': limits,
+                    'wall_limit': parent['wall_limit'] if parent is not None else None,
+                    'deadline': parent['deadline'] if parent is not None else None,
+                }
+                if sibling['deadline'] is not None:
+                    heapq.heappush(self.deadlines, (sibling['deadline'], pid))
+                self._watch_pid(pid)
+                continue
+
+            # Sibling
+            for fd in fds:
+                if fd != channel and fd not in stdio:
+                    os.close(fd)
+            self._close_master_fds()
+            status = 0
+            try:
+                pyseidon.parallel.master = self
+                pyseidon.parallel.serve(channel, stdio, limits)
+            except (BrokenPipeError, ConnectionResetError):
+                # The worker stopped listening
+                pass
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                for stream in (sys.stdout, sys.stderr):
+                    try:
+                        stream.flush()
+                    except Exception:
+                        pass
+                os._exit(status)
+        for fd in fds:
+            os.close(fd)
+        print('[{}] Forked {} of {} siblings for worker {}'.format(os.getpid(), len(channels), len(fds) - 2, message['pid']), file=sys.stderr)
+
+    def _preload_imports(self):
+        imported, failed, seconds = self.import_profile.preload()
+        if imported or failed:
+            print('[{}] Preloaded {} modules workers imported before, in {:.3f}s ({} failed)'.format(os.getpid(), len(imported), seconds, len(failed)), file=sys.stderr)
+
+    def _check_client(self, child, conn):
+        # We want to detect when a client has hung up (so we can
+        # tell the child about this). See
+        # http://stefan.buettcher.org/cs/conn_closed.html for
+        # another way of solving this problem with poll(2).
+        data = self._socket_peek(conn)
+        if data is None:
+            # Spurious wakeup
+            return
+        elif len(data) == 0:
+            self._notify_socket_dead(child)
+        else:
+            raise RuntimeError('Socket unexpectedly had available data: child={} data={}'.format(child['pid'], data))
 
     def _socket_peek(self, sock):
         try:
@@ -107,6 +997,8 @@ class Pyseidon(object):
 
     def _notify_socket_dead(self, child):
         child['notified'] = True
+        # The hung-up socket would otherwise stay readable forever
+        self._remove_reader(child['conn'])
         print('[{}] Client disconnected; sending HUP: child={}'.format(os.getpid(), child['pid']), file=sys.stderr)
         try:
             # HUP is about right for this.
@@ -117,53 +1009,1218 @@ class Pyseidon(object):
             if e.errno != errno.ESRCH:
                 raise
 
-    def _listen(self):
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    def _bind(self, path, backlog):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
         # Make sure this socket is readable only by the current user,
         # since it'll give possibly arbitrary code execution to anyone
         # who can connect to it.
         umask = os.umask(0o077)
         try:
-            self.sock.bind(self.path)
+            sock.bind(path)
         finally:
             os.umask(umask)
-        atexit.register(self._remove_socket)
+        atexit.register(self._remove_socket, path, os.getpid())
+
+        sock.listen(backlog)
+        # Several masters may be accepting from it at once (old and
+        # new generations, while reloading), so losing a race for a
+        # connection mustn't block.
+        sock.setblocking(False)
+        return sock
 
-        self.sock.listen(1)
+    def _listen(self, backlog):
+        self.sock = self._bind(self.path, backlog)
+        self._add_reader(self.sock, self._accept)
         print('[{}] Pyseidon master booted'.format(os.getpid()), file=sys.stderr)
 
-    def _accept(self):
-        conn, _ = self.sock.accept()
+    def _accept(self, sock):
+        try:
+            conn, _ = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        # The handshake is read incrementally from the event loop, so
+        # a slow or misbehaving client can't stall everyone else.
+        conn.setblocking(False)
+        self.handshakes[conn] = _Handshake(conn)
+        self._add_reader(conn, self._continue_handshake)
+
+    def _continue_handshake(self, conn):
+        handshake = self.handshakes[conn]
+        try:
+            data, fds = _recvmsg(conn)
+            if not data and not fds:
+                mux = self.muxes.get(conn)
+                if mux is None:
+                    print('[{}] Client hung up mid-handshake'.format(os.getpid()), file=sys.stderr)
+                elif mux['jobs']:
+                    print('[{}] Multiplexing client hung up; abandoning {} jobs'.format(os.getpid(), len(mux['jobs'])), file=sys.stderr)
+                self._drop_handshake(handshake)
+                return
+            done = handshake.feed(data, fds)
+            # More requests may follow a multiplexed one, and may
+            # already be here
+            while done and 'job' in handshake.options:
+                argv = self._start_job(conn, handshake)
+                if not self._is_master():
+                    return argv
+                handshake = self.handshakes[conn]
+                done = handshake.feed(b'', [])
+        except (BlockingIOError, InterruptedError):
+            return
+        except (ProtocolError, socket.error) as e:
+            print('[{}] Dropping client with bad handshake: {}'.format(os.getpid(), e), file=sys.stderr)
+            if isinstance(e, UnsupportedProtocol):
+                self._refuse_protocol(handshake)
+            self._drop_handshake(handshake)
+            return
+
+        if not done:
+            return
+        del self.handshakes[conn]
+        self.tcp_handshakes.pop(conn, None)
+        self._remove_reader(conn)
+        if handshake.tcp:
+            return self._start_stream(conn, handshake)
+        return self._dispatch_request(conn, handshake)
+
+    def _dispatch_request(self, conn, handshake):
+        handshake.completed_at = time.monotonic()
+        self.stats.incr('requests_total')
+        self.stats.observe('handshake_seconds', handshake.completed_at - handshake.accepted_at)
+        profile = handshake.options.get('profile', handshake.env.get(b'POSEIDON_PROFILE', b'').decode('utf-8', 'replace'))
+        if profile and self.profile is None:
+            self._route(conn, handshake, profile)
+            return
+        return self._admit(conn, handshake)
+
+    def _start_job(self, conn, handshake):
+        # Each job on a multiplexed connection gets a socketpair standing
+        # in for a connection of its own, so it's served (and notices
+        # the client hanging up) like any other. Its result comes back
+        # to us on the other end, to be passed on with the job's id.
+        try:
+            job = int(handshake.options['job'])
+        except ValueError:
+            raise ProtocolError('Bad job id: {!r}'.format(handshake.options['job']))
+        if job <= 0 or job >= 2**64:
+            raise ProtocolError('Bad job id: {!r}'.format(handshake.options['job']))
+        mux = self.muxes.get(conn)
+        if mux is None:
+            mux = self.muxes[conn] = {
+                'conn': conn,
+                # The selector takes one registration per file object,
+                # and we read and write at once
+                'writer': conn.dup(),
+                # Job ids, by our end of their socketpair
+                'jobs': {},
+                'out': bytearray(),
+                'writing': False,
+                'retiring': False,
+            }
+            self.stats.incr('multiplexed_connections_total')
+        following = _Handshake(conn)
+        following.buf, handshake.buf = handshake.buf, bytearray()
+        following.fds, handshake.fds = handshake.fds[3:], handshake.fds[:3]
+        self.handshakes[conn] = following
+
+        job_conn, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        job_conn.setblocking(False)
+        peer.setblocking(False)
+        mux['jobs'][peer] = job
+        self._add_reader(peer, functools.partial(self._read_job_result, mux, job, bytearray()))
+        handshake.conn = job_conn
+        return self._dispatch_request(job_conn, handshake)
+
+    def _read_job_result(self, mux, job, buf, peer):
+        try:
+            data = peer.recv(_RECVSIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        if data:
+            buf += data
+            return
+        # The job's connection is closed once its result is sent
+        self._remove_reader(peer)
+        peer.close()
+        del mux['jobs'][peer]
+        if len(buf) < 8:
+            # Dropped without an answer
+            buf = _pack_result(2, 100)
+        mux['out'] += _pack_job_result(job, buf)
+        self._flush_mux(mux)
+
+    def _flush_mux(self, mux, writer=None):
+        try:
+            while mux['out']:
+                del mux['out'][:mux['writer'].send(mux['out'])]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except socket.error as e:
+            # The reading side will find out the client's gone
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            mux['out'] = bytearray()
+        writing = bool(mux['out'])
+        if writing and not mux['writing']:
+            self._add_writer(mux['writer'], functools.partial(self._flush_mux, mux))
+        elif not writing and mux['writing']:
+            self._remove_writer(mux['writer'])
+        mux['writing'] = writing
+        if mux['retiring'] and not mux['jobs'] and not writing:
+            self._close_mux(mux)
+
+    def _retire_mux(self, mux):
+        # Stop reading requests. Any we haven't fully read are for the
+        # client to send again elsewhere.
+        mux['retiring'] = True
+        self._drop_handshake(self.handshakes[mux['conn']], close_mux=False)
+        mux['out'] += _pack_job_result(0, _pack_result(2, 0))
+        self._flush_mux(mux)
+
+    def _close_mux(self, mux):
+        for peer in mux['jobs']:
+            # Jobs still running see their client hang up
+            self._remove_reader(peer)
+            peer.close()
+        mux['jobs'] = {}
+        if mux['writing']:
+            self._remove_writer(mux['writer'])
+            mux['writing'] = False
+        mux['writer'].close()
+        del self.muxes[mux['conn']]
+
+    def _listen_tcp(self, address, token, backlog):
+        if not token:
+            raise ValueError('Listening on TCP needs a tcp_token')
+        self.tcp_token = token.encode('utf-8')
+        self.tcp_sock = socket.create_server(address, backlog=backlog)
+        self.tcp_sock.setblocking(False)
+        self._add_reader(self.tcp_sock, self._accept_tcp)
+        print('[{}] Listening for TCP clients on {}:{}'.format(os.getpid(), *self.tcp_sock.getsockname()[:2]), file=sys.stderr)
+
+    def _accept_tcp(self, sock):
+        try:
+            conn, _ = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(self.tcp_handshakes) >= _MAX_TCP_HANDSHAKES:
+            print('[{}] Turning away TCP client: {} handshakes already in progress'.format(os.getpid(), len(self.tcp_handshakes)), file=sys.stderr)
+            conn.close()
+            return
+        conn.setblocking(False)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handshake = _Handshake(conn, tcp_token=self.tcp_token)
+        self.handshakes[conn] = handshake
+        self.tcp_handshakes[conn] = handshake
+        self._add_reader(conn, self._continue_handshake)
+
+    def _start_stream(self, conn, handshake):
+        # A TCP client can't send us its FDs. Its worker gets pipes
+        # instead, which we pump to and from the connection as frames,
+        # and, like a multiplexed job, a socketpair standing in for its
+        # connection. Its result comes back to us on the other end, to
+        # go out once all its output has. Its token was checked in the
+        # handshake.
+        self.stats.incr('tcp_connections_total')
+        stdin, stdin_writer = os.pipe()
+        stdout_reader, stdout = os.pipe()
+        stderr_reader, stderr = os.pipe()
+        for fd in (stdin_writer, stdout_reader, stderr_reader):
+            os.set_blocking(fd, False)
+            if hasattr(fcntl, 'F_SETPIPE_SZ'):
+                # Fewer, bigger reads and writes (Linux only)
+                try:
+                    fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, _STREAM_CHUNK)
+                except OSError:
+                    # Over the system's limit
+                    pass
+        job_conn, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        job_conn.setblocking(False)
+        peer.setblocking(False)
+        stream = self.streams[conn] = {
+            'conn': conn,
+            'writer': conn.dup(),
+            'peer': peer,
+            # Frames from the client we haven't parsed yet
+            'in': handshake.buf,
+            'stdin': stdin_writer,
+            'stdin_buf': bytearray(),
+            'stdin_eof': False,
+            'stdin_writing': False,
+            'reading': True,
+            # Stream number, by the pipes we're still reading
+            'outputs': {stdout_reader: 1, stderr_reader: 2},
+            'paused': False,
+            'out': bytearray(),
+            'writing': False,
+            'finished': False,
+        }
+        self._add_reader(conn, functools.partial(self._read_stream_input, stream))
+        for fd in stream['outputs']:
+            self._add_reader(fd, functools.partial(self._read_stream_output, stream))
+        self._add_reader(peer, functools.partial(self._read_stream_result, stream, bytearray()))
+        handshake.buf = bytearray()
+        handshake.fds = [stdin, stdout, stderr]
+        handshake.conn = job_conn
+        self._parse_stream_input(stream)
+        if conn not in self.streams:
+            handshake.close()
+            return
+        return self._dispatch_request(job_conn, handshake)
+
+    def _read_stream_input(self, stream, conn):
+        try:
+            data = conn.recv(_STREAM_CHUNK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        if not data:
+            # Its worker sees the client hang up, as any other would
+            print('[{}] TCP client hung up'.format(os.getpid()), file=sys.stderr)
+            self._close_stream(stream)
+            return
+        stream['in'] += data
+        self._parse_stream_input(stream)
+
+    def _parse_stream_input(self, stream):
+        buf = stream['in']
+        pos = 0
+        while len(buf) - pos >= _STREAM_FRAME.size:
+            kind, length = _STREAM_FRAME.unpack_from(buf, pos)
+            if kind != 0:
+                print('[{}] Dropping TCP client that sent a frame of type {}'.format(os.getpid(), kind), file=sys.stderr)
+                self._close_stream(stream)
+                return
+            if length > _STREAM_CHUNK:
+                # Or we'd have to hold all of it before passing it on
+                print('[{}] Dropping TCP client that sent a {}-byte frame'.format(os.getpid(), length), file=sys.stderr)
+                self._close_stream(stream)
+                return
+            if len(buf) - pos - _STREAM_FRAME.size < length:
+                break
+            pos += _STREAM_FRAME.size
+            if length == 0:
+                stream['stdin_eof'] = True
+            elif stream['stdin'] is not None:
+                stream['stdin_buf'] += buf[pos:pos + length]
+            pos += length
+        del buf[:pos]
+        self._flush_stdin(stream)
+
+    def _flush_stdin(self, stream, fd=None):
+        try:
+            while stream['stdin_buf']:
+                del stream['stdin_buf'][:os.write(stream['stdin'], stream['stdin_buf'])]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # The worker's done with its stdin; drop whatever else
+            # comes for it
+            stream['stdin_buf'] = bytearray()
+            stream['stdin_eof'] = True
+        writing = bool(stream['stdin_buf'])
+        if writing and not stream['stdin_writing']:
+            self._add_writer(stream['stdin'], functools.partial(self._flush_stdin, stream))
+        elif not writing and stream['stdin_writing']:
+            self._remove_writer(stream['stdin'])
+        stream['stdin_writing'] = writing
+        if stream['stdin_eof'] and not writing and stream['stdin'] is not None:
+            os.close(stream['stdin'])
+            stream['stdin'] = None
+
+        # Stop taking stdin from the client while the worker isn't
+        # reading it
+        reading = len(stream['stdin_buf']) < _STREAM_HIGH_WATER
+        if reading and not stream['reading']:
+            self._add_reader(stream['conn'], functools.partial(self._read_stream_input, stream))
+        elif not reading and stream['reading']:
+            self._remove_reader(stream['conn'])
+        stream['reading'] = reading
+
+    def _read_stream_output(self, stream, fd):
+        try:
+            data = os.read(fd, _STREAM_CHUNK)
+        except (BlockingIOError, InterruptedError):
+            return
+        if data:
+            frame = _STREAM_FRAME.pack(stream['outputs'][fd], len(data))
+            sent = 0
+            if not stream['out']:
+                # Nothing's queued ahead of it, so try sending it
+                # straight out rather than copying it in first
+                try:
+                    sent = stream['writer'].sendmsg([frame, data])
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except socket.error as e:
+                    if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                        raise
+                    self._close_stream(stream)
+                    return
+            if sent < len(frame):
+                stream['out'] += frame[sent:]
+                stream['out'] += data
+            else:
+                stream['out'] += memoryview(data)[sent - len(frame):]
+        else:
+            self._remove_reader(fd)
+            os.close(fd)
+            del stream['outputs'][fd]
+        self._flush_stream(stream)
+
+    def _flush_stream(self, stream, writer=None):
+        try:
+            while stream['out']:
+                del stream['out'][:stream['writer'].send(stream['out'])]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except socket.error as e:
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            self._close_stream(stream)
+            return
+        writing = bool(stream['out'])
+        if writing and not stream['writing']:
+            self._add_writer(stream['writer'], functools.partial(self._flush_stream, stream))
+        elif not writing and stream['writing']:
+            self._remove_writer(stream['writer'])
+        stream['writing'] = writing
+        if stream['finished'] and not writing:
+            self._close_stream(stream)
+            return
+
+        # Stop reading the worker's output while the client isn't
+        # reading it
+        paused = len(stream['out']) >= _STREAM_HIGH_WATER
+        if paused != stream['paused']:
+            for fd in stream['outputs']:
+                if paused:
+                    self._remove_reader(fd)
+                else:
+                    self._add_reader(fd, functools.partial(self._read_stream_output, stream))
+        stream['paused'] = paused
+
+    def _read_stream_result(self, stream, buf, peer):
+        try:
+            data = peer.recv(_RECVSIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        if data:
+            buf += data
+            return
+        self._remove_reader(peer)
+        peer.close()
+        stream['peer'] = None
+        if len(buf) < 8:
+            # Dropped without an answer
+            buf = _pack_result(2, 100)
+        # The worker's gone, so what it wrote is already in the pipes.
+        # Anything still holding them open (say, a process it started)
+        # doesn't get to hold up the result.
+        for fd, number in list(stream['outputs'].items()):
+            while True:
+                try:
+                    data = os.read(fd, _STREAM_CHUNK)
+                except (BlockingIOError, InterruptedError):
+                    break
+                if not data:
+                    break
+                stream['out'] += _STREAM_FRAME.pack(number, len(data))
+                stream['out'] += data
+            if not stream['paused']:
+                self._remove_reader(fd)
+            os.close(fd)
+        stream['outputs'] = {}
+        stream['out'] += _STREAM_FRAME.pack(_FRAME_EXIT, len(buf) - 4)
+        stream['out'] += buf[4:]
+        stream['finished'] = True
+        self._flush_stream(stream)
+
+    def _close_stream(self, stream):
+        if self.streams.pop(stream['conn'], None) is None:
+            return
+        if stream['reading']:
+            self._remove_reader(stream['conn'])
+        stream['conn'].close()
+        if stream['writing']:
+            self._remove_writer(stream['writer'])
+        stream['writer'].close()
+        if stream['peer'] is not None:
+            # Its worker sees its connection close, and is sent SIGHUP
+            self._remove_reader(stream['peer'])
+            stream['peer'].close()
+        if stream['stdin'] is not None:
+            if stream['stdin_writing']:
+                self._remove_writer(stream['stdin'])
+            os.close(stream['stdin'])
+        for fd in stream['outputs']:
+            if not stream['paused']:
+                self._remove_reader(fd)
+            os.close(fd)
+
+    def _admit(self, conn, handshake):
+        if self.in_process is not None:
+            self._run_in_process(conn, handshake)
+            return
+        handshake.limits = self._job_limits(handshake)
+        if self.cache is not None and self.cache.is_cacheable(handshake.env):
+            handshake.cache_key = self.cache.key(handshake.argv, handshake.env, handshake.cwd)
+            result = self.cache.get(handshake.cache_key)
+            if result is not None:
+                self.stats.incr('cache_hits_total')
+                self._replay(conn, handshake, result)
+                return
+            handshake.capture = tempfile.TemporaryFile()
+        self._enqueue(conn, handshake)
+        return self._dispatch_queued()
+
+    def _route(self, conn, handshake, name):
+        # Pass the client, FDs and all, to its profile's master
+        profile = self.profiles.get(name)
+        if profile is None or profile['channel'] is None:
+            print('[{}] No master for profile {!r}; failing client: argv={}'.format(os.getpid(), name, handshake.argv), file=sys.stderr)
+            for fd in handshake.fds:
+                os.close(fd)
+            handshake.fds = []
+            # Same arbitrary status as a worker dying from a signal
+            self._send_result(conn, handshake.version, 100)
+            return
+        self.stats.incr('routed_total')
+        request = self._request(handshake)
+        request.update({
+            'version': handshake.version,
+            'accepted_at': handshake.accepted_at,
+            # The client's three FDs, then the connection itself
+            'nfds': len(handshake.fds) + 1,
+        })
+        data = pickle.dumps(request, pickle.HIGHEST_PROTOCOL)
+        profile['backlog'].append({
+            'conn': conn,
+            'version': handshake.version,
+            'fds': handshake.fds,
+            'data': memoryview(struct.pack('<I', len(data)) + data),
+        })
+        if not profile['writing']:
+            self._flush_routed(profile, profile['channel'])
+
+    def _flush_routed(self, profile, channel):
+        # The channel is non-blocking: a profile master that's still
+        # running its setup can't hold up everyone else. FDs go along
+        # with the first byte of each message.
+        backlog = profile['backlog']
+        error = None
+        while backlog:
+            entry = backlog[0]
+            try:
+                if entry['conn'] is not None:
+                    fds = entry['fds'] + [entry['conn'].fileno()]
+                    sent = channel.sendmsg([entry['data']], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+                    # The profile's master has its own copies now
+                    for fd in entry['fds']:
+                        os.close(fd)
+                    entry['conn'].close()
+                    entry['conn'] = None
+                else:
+                    sent = channel.send(entry['data'])
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error as e:
+                # Its master is gone; clients still here get failed
+                # once it's reaped.
+                print('[{}] Could not route to profile {!r}: {}'.format(os.getpid(), profile['name'], e), file=sys.stderr)
+                error = e
+                break
+            entry['data'] = entry['data'][sent:]
+            if not entry['data']:
+                backlog.popleft()
+        writing = bool(backlog) and error is None
+        if writing and not profile['writing']:
+            self._add_writer(channel, functools.partial(self._flush_routed, profile))
+        elif not writing and profile['writing']:
+            self._remove_writer(channel)
+        profile['writing'] = writing
+
+    def _read_routed(self, channel):
+        # Profile master side: clients the base master passed on
+        try:
+            data, fds = _recvmsg(channel)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.routed_fds.extend(fds)
+        if not data:
+            # The base master is retiring (or gone)
+            self._remove_reader(channel)
+            for fd in self.routed_fds:
+                os.close(fd)
+            self.routed_fds = []
+            self._drain()
+            return
+        self.routed_buf += data
+        while len(self.routed_buf) >= 4:
+            length, = struct.unpack_from('<I', self.routed_buf)
+            if len(self.routed_buf) < length + 4:
+                break
+            request = pickle.loads(bytes(self.routed_buf[4:length + 4]))
+            del self.routed_buf[:length + 4]
+            fds = self.routed_fds[:request['nfds']]
+            del self.routed_fds[:request['nfds']]
+            conn = socket.socket(fileno=fds.pop())
+            conn.setblocking(False)
+            handshake = _Handshake(conn)
+            handshake.state = 'done'
+            handshake.fds = fds
+            handshake.accepted_at = request['accepted_at']
+            handshake.version = request['version']
+            handshake.argv = request['argv']
+            handshake.env = request['env']
+            handshake.cwd = request['cwd']
+            handshake.options = request['options']
+            handshake.tcp = request['tcp']
+            argv = self._admit(conn, handshake)
+            if not self._is_master():
+                return argv
+
+    def _start_profiles(self):
+        for profile in self.profiles.values():
+            channel, master_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            pid = self._fork()
+            if pid:
+                master_channel.close()
+                channel.setblocking(False)
+                profile['pid'] = pid
+                profile['channel'] = channel
+                profile['ready'] = False
+                self._watch_pid(pid)
+                print('[{}] Forked master for profile {!r}: pid={}'.format(os.getpid(), profile['name'], pid), file=sys.stderr)
+                continue
+
+            channel.close()
+            self._become_profile_master(profile, master_channel)
+            return
+        # Each profile's master has its own socket now
+        for profile in self.profiles.values():
+            if profile['sock'] is not None:
+                profile['sock'].close()
+                profile['sock'] = None
+
+    def _become_profile_master(self, profile, channel):
+        sock, profile['sock'] = profile['sock'], None
+        parent_reports = self.report_writer.dup()
+        # The base's sockets, and other profiles'
+        self._close_listeners()
+        self._start_over()
+        self.profiles = {}
+        self.profile = profile
+        self.profile_channel = channel
+        self.routed_buf = bytearray()
+        self.routed_fds = []
 
-        # Note that these will be blocking, so a slow or misbehaving
-        # client could in theory cause issues. We could solve this by
-        # adding these to the event loop.
-        argv = self._read_argv(conn)
-        env = self._read_env(conn)
-        cwd = self._read_cwd(conn)
-        fds = self._read_fds(conn)
+        if profile['setup'] is not None:
+            profile['setup']()
+        if self.import_profile is not None:
+            self.import_profile = self.import_profile.for_profile(profile['name'])
+            self._preload_imports()
+        if self.freeze_gc:
+            gc.collect()
+            gc.freeze()
+        channel.setblocking(False)
+        self._add_reader(channel, self._read_routed)
+        if sock is not None:
+            self.sock = sock
+            self._add_reader(sock, self._accept)
+        print('[{}] Master for profile {!r} ready'.format(os.getpid(), profile['name']), file=sys.stderr)
+        self.report_writer, parent_reports = parent_reports, self.report_writer
+        self._report({'type': 'profile_ready', 'name': profile['name']})
+        self.report_writer, parent_reports = parent_reports, self.report_writer
+        parent_reports.close()
 
-        pid = os.fork()
+    def _start_over(self):
+        # Become a fresh master, without any of the bookkeeping for our
+        # parent's clients and workers
+        pool_size, use_pidfd = self.pool_size, self.use_pidfd
+        self._close_master_fds(listeners=False)
+        self.report_writer.close()
+        self._init_master_state()
+        self.pool_size, self.use_pidfd = pool_size, use_pidfd
+
+    def _on_profile_ready(self, message):
+        profile = self.profiles.get(message['name'])
+        if profile is not None:
+            profile['ready'] = True
+            self._check_ready()
+
+    def _start_in_process(self, handler, threads):
+        pyseidon.inprocess.install()
+        self.in_process = {
+            'handler': handler,
+            'executor': concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='pyseidon'),
+        }
+        # Forking with other threads running is asking for trouble,
+        # and there's nothing to fork for anyway.
+        self.pool_size = 0
+        print('[{}] Serving requests in-process on {} threads'.format(os.getpid(), threads), file=sys.stderr)
+
+    def _run_in_process(self, conn, handshake):
+        self.stats.incr('in_process_total')
+        self.in_process_running += 1
+        fds, handshake.fds = handshake.fds, []
+        future = self.in_process['executor'].submit(pyseidon.inprocess.run, self.in_process['handler'], self._request(handshake), fds, self._exit_status)
+        future.add_done_callback(functools.partial(self._in_process_done, conn, handshake))
+
+    def _in_process_done(self, conn, handshake, future):
+        # On the executor's thread: leave the rest to the event loop
+        self.in_process_results.append((conn, handshake, future))
+        self._break_loop(None, None)
+
+    def _finish_in_process(self, conn, handshake, future):
+        self.in_process_running -= 1
+        try:
+            status = future.result()
+        except Exception as e:
+            print('[{}] In-process request failed: argv={}: {}'.format(os.getpid(), handshake.argv, e), file=sys.stderr)
+            status = 1
+        self.stats.observe('request_seconds', time.monotonic() - handshake.accepted_at)
+        self._send_result(conn, handshake.version, status)
+
+    def _check_ready(self):
+        # A new generation only starts taking clients, and has the
+        # zygote retire the old one, once all its profiles are set up.
+        if self.generation_channel is None or self.generation_ready:
+            return
+        if not all(profile['ready'] for profile in self.profiles.values()):
+            return
+        self.generation_ready = True
+        self._add_reader(self.sock, self._accept)
+        if self.control_sock is not None:
+            self._add_reader(self.control_sock, self._accept_control)
+        if self.tcp_sock is not None:
+            self._add_reader(self.tcp_sock, self._accept_tcp)
+        print('[{}] Generation {} master ready'.format(os.getpid(), self.generation), file=sys.stderr)
+        self.generation_channel.send(b'ready')
+
+    def _read_generation(self, channel):
+        try:
+            data = channel.recv(64)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        if data:
+            return
+        # The zygote hung up: a newer generation is serving (or the
+        # zygote itself is gone)
+        self._remove_reader(channel)
+        channel.close()
+        self.generation_channel = None
+        self._drain()
+
+    def _drain(self):
+        # Stop taking new clients, see the ones we have through, then
+        # exit
+        print('[{}] Draining: waiting on {} workers before exiting'.format(os.getpid(), len(self.children)), file=sys.stderr)
+        self.draining = True
+        for sock in (self.sock, self.control_sock, self.tcp_sock):
+            if sock is None:
+                continue
+            try:
+                self._remove_reader(sock)
+            except KeyError:
+                # Never got as far as taking clients
+                pass
+        self._close_listeners()
+        for worker in self.pool.values():
+            worker['channel'].close()
+        self.pool = {}
+        self.pool_size = 0
+        for mux in list(self.muxes.values()):
+            if not mux['retiring']:
+                self._retire_mux(mux)
+        self._check_drained()
+
+    def _check_drained(self):
+        if self.handshakes:
+            return
+        # No more clients can need routing, so profile masters can
+        # drain, too, once they've been handed everything.
+        for profile in self.profiles.values():
+            if profile['channel'] is not None and not profile['writing']:
+                profile['channel'].close()
+                profile['channel'] = None
+        if self.children or self.outgoing or self.replaying or self.in_process_running or self.muxes or self.streams or self.siblings:
+            return
+        if any(not entry['dropped'] for _, _, entry in self.queue):
+            return
+        if any(profile['pid'] is not None for profile in self.profiles.values()):
+            return
+        print('[{}] Drained; exiting'.format(os.getpid()), file=sys.stderr)
+        sys.exit(0)
+
+    def _serve_generations(self, watch, interval):
+        # The process that called run() stays behind as a pristine
+        # zygote: it holds the listening sockets and never serves a
+        # client itself. Each generation of master is forked from it
+        # and re-imports just the modules that have changed since, so
+        # nothing it loaded is ever reloaded twice. Returns those
+        # modules' names in the new generation's master.
+        modules = _watched_modules(watch)
+        base = _module_mtimes(modules)
+        print('[{}] Watching {} modules for changes'.format(os.getpid(), len(modules)), file=sys.stderr)
+        generations = {}
+        current = pending = None
+        built = None
+        number = 0
+        while True:
+            mtimes = _module_mtimes(modules)
+            if pending is None and mtimes != built:
+                changed = [name for name in modules if mtimes[name] != base[name]]
+                built = mtimes
+                number += 1
+                pending = self._fork_generation(number, changed, generations)
+                if pending is None:
+                    return changed
+                generations[pending['channel']] = pending
+
+            readable, _, _ = select.select(list(generations), [], [], interval)
+            for channel in readable:
+                generation = generations[channel]
+                try:
+                    data = channel.recv(64)
+                except socket.error:
+                    data = b''
+                if data and generation is pending:
+                    if current is not None:
+                        print('[{}] Generation {} is serving; draining generation {}'.format(os.getpid(), pending['number'], current['number']), file=sys.stderr)
+                        del generations[current['channel']]
+                        current['channel'].close()
+                    current, pending = pending, None
+                elif not data:
+                    del generations[channel]
+                    channel.close()
+                    if generation is pending:
+                        print('[{}] Generation {} failed to start; waiting for further changes'.format(os.getpid(), generation['number']), file=sys.stderr)
+                        pending = None
+                    elif generation is current:
+                        print('[{}] Generation {} master died; starting another'.format(os.getpid(), generation['number']), file=sys.stderr)
+                        current = None
+                        built = None
+            self._reap_generations()
+
+    def _fork_generation(self, number, changed, generations):
+        channel, generation_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = self._fork()
+        if pid:
+            generation_channel.close()
+            print('[{}] Forked generation {} master: pid={} reloading={}'.format(os.getpid(), number, pid, changed), file=sys.stderr)
+            return {'number': number, 'pid': pid, 'channel': channel}
+
+        channel.close()
+        # Otherwise older generations would never see the zygote
+        # hang up on them
+        for other in generations:
+            other.close()
+        self._start_over()
+        self.generation = number
+        self.generation_channel = generation_channel
+        try:
+            for name in changed:
+                importlib.reload(sys.modules[name])
+        except Exception:
+            traceback.print_exc()
+            os._exit(1)
+        if self.import_profile is not None:
+            # Pick up whatever earlier generations' workers recorded
+            self.import_profile = pyseidon.imports.ImportProfile(self.import_profile.path, min_seconds=self.import_profile.min_seconds)
+            self._preload_imports()
+        self._add_reader(generation_channel, self._read_generation)
+        return None
+
+    def _reap_generations(self):
+        while True:
+            try:
+                pid, exitinfo = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            print('[{}] Generation master {} exited with status {}'.format(os.getpid(), pid, exitinfo >> 8), file=sys.stderr)
+
+    def _priority(self, handshake):
+        # Higher runs first. Clients set it via a v2 option or their
+        # environment.
+        value = handshake.options.get('priority', handshake.env.get(b'POSEIDON_PRIORITY', b'0'))
+        try:
+            return int(value)
+        except ValueError:
+            return 0
+
+    def _enqueue(self, conn, handshake):
+        entry = {'conn': conn, 'handshake': handshake, 'queued_at': time.monotonic(), 'dropped': False}
+        self.queue_seq += 1
+        heapq.heappush(self.queue, (-self._priority(handshake), self.queue_seq, entry))
+        # Notice if a queued client gives up waiting
+        self._add_reader(conn, functools.partial(self._check_queued, entry))
+
+    def _check_queued(self, entry, conn):
+        data = self._socket_peek(conn)
+        if data is None:
+            return
+        print('[{}] Queued client went away: argv={}'.format(os.getpid(), entry['handshake'].argv), file=sys.stderr)
+        entry['dropped'] = True
+        self._remove_reader(conn)
+        entry['handshake'].close()
+
+    def _memory_ok(self):
+        if self.min_available_memory is None:
+            return True
+        available = _available_memory()
+        return available is None or available >= self.min_available_memory
+
+    def _room(self):
+        # How many more workers (or siblings) we can fork right now
+        if not self._memory_ok():
+            return 0
+        if self.max_workers is None:
+            return None
+        return max(self.max_workers - len(self.children) - len(self.siblings), 0)
+
+    def _can_admit(self):
+        return self._room() != 0
+
+    def _dispatch_queued(self):
+        while self.queue:
+            if self.queue[0][2]['dropped']:
+                heapq.heappop(self.queue)
+                continue
+            if not self._can_admit():
+                return
+            _, _, entry = heapq.heappop(self.queue)
+            conn, handshake = entry['conn'], entry['handshake']
+            self._remove_reader(conn)
+            self.stats.observe('queue_seconds', time.monotonic() - entry['queued_at'])
+            if self.pool:
+                argv = self._dispatch_to_pool(conn, handshake)
+            else:
+                argv = self._spawn(conn, handshake)
+            if not self._is_master():
+                return argv
+
+    def _refuse_protocol(self, handshake):
+        # Tell the client which versions we speak before hanging up.
+        # Best-effort: the result is small enough for any socket
+        # buffer, and a client that's gone has nothing to learn.
+        if handshake.conn in self.muxes:
+            # Its other jobs' results are framed; an unframed result
+            # would only garble them
+            return
+        versions = (PROTOCOL_VERSION,) if handshake.tcp else SUPPORTED_VERSIONS
+        body = struct.pack('<i', UNSUPPORTED_PROTOCOL_STATUS)
+        body += 'supported={}'.format(','.join(str(v) for v in versions)).encode() + b'\0'
+        if handshake.tcp:
+            msg = _STREAM_FRAME.pack(_FRAME_EXIT, len(body)) + body
+        else:
+            msg = struct.pack('<I', len(body)) + body
+        try:
+            handshake.conn.send(msg)
+        except socket.error:
+            pass
+
+    def _drop_handshake(self, handshake, close_mux=True):
+        del self.handshakes[handshake.conn]
+        self.tcp_handshakes.pop(handshake.conn, None)
+        self._remove_reader(handshake.conn)
+        if close_mux and handshake.conn in self.muxes:
+            self._close_mux(self.muxes[handshake.conn])
+        handshake.close()
+
+    def _replay(self, conn, handshake, result):
+        # Answer from the cache without forking: write out the stored
+        # output as the client's FDs become writable, then send the
+        # exit status.
+        stdout, stderr, status = result
+        print('[{}] Cache hit: argv={} cwd={}'.format(os.getpid(), handshake.argv, handshake.cwd), file=sys.stderr)
+        stdin_fd, stdout_fd, stderr_fd = handshake.fds
+        handshake.fds = []
+        os.close(stdin_fd)
+        replay = {'conn': conn, 'version': handshake.version, 'status': status, 'pending': 2}
+        self.replaying += 1
+        for fd, data in ((stdout_fd, stdout), (stderr_fd, stderr)):
+            stream = {'fd': fd, 'data': memoryview(data)}
+            try:
+                self._add_writer(fd, functools.partial(self._continue_replay, replay, stream))
+            except PermissionError:
+                # epoll refuses regular files, which never block anyway
+                self._continue_replay(replay, stream, fd, blocking=True)
+
+    def _continue_replay(self, replay, stream, fd, blocking=False):
+        registered = not blocking
+        try:
+            while stream['data']:
+                # A pipe that polls writable has room for at least
+                # PIPE_BUF bytes, so this write won't block.
+                chunk = stream['data'] if blocking else stream['data'][:select.PIPE_BUF]
+                stream['data'] = stream['data'][os.write(fd, chunk):]
+                if not blocking:
+                    break
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # Client went away; the status send will find out too
+            print('[{}] Could not replay cached output: {}'.format(os.getpid(), e), file=sys.stderr)
+            stream['data'] = b''
+        if stream['data']:
+            return
+
+        if registered:
+            self._remove_writer(fd)
+        os.close(fd)
+        replay['pending'] -= 1
+        if replay['pending'] == 0:
+            self.replaying -= 1
+            self._send_result(replay['conn'], replay['version'], replay['status'])
+
+    def _spawn(self, conn, handshake):
+        fork_start = time.monotonic()
+        pid = self._fork()
         if pid:
             # Master
-            print('[{}] Spawned worker: pid={} argv={} cwd={}'.format(os.getpid(), pid, argv, cwd), file= sys.stderr)
+            self.stats.observe('fork_seconds', time.monotonic() - fork_start)
+            print('[{}] Spawned worker: pid={} argv={} cwd={}'.format(os.getpid(), pid, handshake.argv, handshake.cwd), file= sys.stderr)
             # Do not want these FDs
-            for fd in fds:
-                fd.close()
-            self.children[pid] = {'conn': conn, 'pid': pid, 'notified': False}
+            for fd in handshake.fds:
+                os.close(fd)
+            self._add_child(pid, conn, handshake)
         else:
             # Worker
-            self._setup_env(conn, argv, env, cwd, fds)
-            return argv
+            fds = handshake.fds
+            if handshake.capture is not None:
+                fds = fds + [os.dup(handshake.capture.fileno())]
+                handshake.capture.close()
+            conn.close()
+            self._close_master_fds()
+            return self._become_worker(self._request(handshake), fds)
+
+    def _request(self, handshake):
+        # Everything a worker needs to know about its client
+        return {
+            'argv': handshake.argv,
+            'env': handshake.env,
+            'cwd': handshake.cwd,
+            'options': handshake.options,
+            'capture_limit': self.cache.max_bytes if handshake.capture is not None else None,
+            'accepted_at': handshake.accepted_at,
+            'limits': handshake.limits,
+            'tcp': handshake.tcp,
+        }
+
+    def _become_worker(self, request, fds):
+        setup_start = time.monotonic()
+        self._setup_env(request['argv'], request['env'], request['cwd'], fds[:3], request['tcp'])
+        self._apply_limits(request['limits'])
+        pyseidon.parallel.master = self
+        if request['capture_limit'] is not None:
+            self._start_capture(fds[3], request['capture_limit'])
+        path = request['options'].get('cprofile', os.environ.get('POSEIDON_CPROFILE'))
+        if path:
+            self.cprofile = {
+                'path': path,
+                # From accept to here: the fork, or the handoff to a
+                # pooled worker
+                'dispatch_seconds': setup_start - request['accepted_at'],
+                'setup_seconds': time.monotonic() - setup_start,
+            }
+        return request['argv']
+
+    def _fork(self):
+        if self.freeze_gc:
+            # Anything the master allocated since the last fork joins
+            # the permanent generation too, so the worker's collector
+            # never writes to (and un-shares) those pages.
+            gc.freeze()
+        return os.fork()
+
+    def _add_child(self, pid, conn, handshake):
+        child = {
+            'conn': conn,
+            'pid': pid,
+            'notified': False,
+            'version': handshake.version,
+            'cache_key': handshake.cache_key,
+            'capture': handshake.capture,
+            'accepted_at': handshake.accepted_at,
+            'spawned_at': time.monotonic(),
+            'limits': handshake.limits,
+            'wall_limit': handshake.limits.get('wall'),
+            'deadline': None,
+        }
+        self.stats.observe('spawn_seconds', child['spawned_at'] - handshake.accepted_at)
+        self.children[pid] = child
+        # Enforced from here, since a worker stuck in C code can't be
+        # relied on to enforce it itself
+        if child['wall_limit'] is not None:
+            child['deadline'] = child['spawned_at'] + child['wall_limit']
+            heapq.heappush(self.deadlines, (child['deadline'], pid))
+        self._add_reader(conn, functools.partial(self._check_client, child))
+        self._watch_pid(pid)
+
+    def _watch_pid(self, pid):
+        if not self.use_pidfd or pid in self.pidfds:
+            return
+        # Fine even if it's already exited: we haven't waited on it,
+        # so the pidfd is just readable straight away.
+        pidfd = os.pidfd_open(pid)
+        self.pidfds[pid] = pidfd
+        self._add_reader(pidfd, functools.partial(self._reap_pidfd, pid))
+
+    def _reap_pidfd(self, pid, pidfd):
+        try:
+            reaped, exitinfo, rusage = os.wait4(pid, os.WNOHANG)
+        except ChildProcessError:
+            # Someone else reaped it
+            reaped = None
+        if reaped == 0:
+            # Spurious wakeup; not dead yet
+            return
+        self._remove_reader(pidfd)
+        os.close(pidfd)
+        del self.pidfds[pid]
+        if reaped is not None:
+            self._handle_exit(pid, exitinfo, rusage)
+
+    def _refill_pool(self):
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = self._fork()
+        if pid:
+            worker_channel.close()
+            self.pool[pid] = {'pid': pid, 'channel': channel}
+            self._watch_pid(pid)
+            return
+
+        # Idle worker: park until the master hands us a client
+        channel.close()
+        self._close_master_fds()
+        request, fds = _recv_handoff(worker_channel)
+        worker_channel.close()
+        if request is None:
+            for fd in fds:
+                os.close(fd)
+            os._exit(0)
+        return self._become_worker(request, fds)
+
+    def _dispatch_to_pool(self, conn, handshake):
+        pid, worker = self.pool.popitem()
+        try:
+            fds = handshake.fds
+            if handshake.capture is not None:
+                fds = fds + [handshake.capture.fileno()]
+            _send_handoff(worker['channel'], self._request(handshake), fds)
+        except socket.error as e:
+            # The idle worker died under us; it'll get reaped as a
+            # non-worker child.
+            print('[{}] Could not hand off to pooled worker {}: {}'.format(os.getpid(), pid, e), file=sys.stderr)
+            worker['channel'].close()
+            if self.pool:
+                return self._dispatch_to_pool(conn, handshake)
+            return self._spawn(conn, handshake)
+        worker['channel'].close()
+        print('[{}] Handed off to pooled worker: pid={} argv={} cwd={}'.format(os.getpid(), pid, handshake.argv, handshake.cwd), file=sys.stderr)
+        for fd in handshake.fds:
+            os.close(fd)
+        self._add_child(pid, conn, handshake)
+
+    def _close_listeners(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.control_sock is not None:
+            self.control_sock.close()
+            self.control_sock = None
+        if self.tcp_sock is not None:
+            self.tcp_sock.close()
+            self.tcp_sock = None
+        for profile in self.profiles.values():
+            if profile['sock'] is not None:
+                profile['sock'].close()
+                profile['sock'] = None
 
-    def _setup_env(self, conn, argv, env, cwd, fds):
+    def _close_master_fds(self, listeners=True):
         # Close now-unneeded file descriptors
-        conn.close()
+        if listeners:
+            self._close_listeners()
         self.loopbreak_reader.close()
         self.loopbreak_writer.close()
-        self.sock.close()
+        self.report_reader.close()
+        for profile in self.profiles.values():
+            if profile['channel'] is not None:
+                profile['channel'].close()
+                profile['channel'] = None
+            for entry in profile['backlog']:
+                if entry['conn'] is not None:
+                    for fd in entry['fds']:
+                        os.close(fd)
+                    entry['conn'].close()
+            profile['backlog'].clear()
+            profile['writing'] = False
+        if self.profile_channel is not None:
+            self.profile_channel.close()
+            self.profile_channel = None
+        if self.generation_channel is not None:
+            self.generation_channel.close()
+            self.generation_channel = None
+        for conn in self.control_conns:
+            conn.close()
+        self.control_conns = {}
+        # Only drops our reference; the master's registrations stay put
+        self.selector.close()
+        # Other clients' half-finished handshakes belong to the master
+        for handshake in list(self.handshakes.values()):
+            handshake.close()
+        self.handshakes = {}
+        self.tcp_handshakes = collections.OrderedDict()
+        for _, _, entry in self.queue:
+            if not entry['dropped']:
+                entry['handshake'].close()
+        self.queue = []
+        for worker in self.pool.values():
+            worker['channel'].close()
+        self.pool = {}
+        for pidfd in self.pidfds.values():
+            os.close(pidfd)
+        self.pidfds = {}
+        self.use_pidfd = False
+        for conn in self.outgoing:
+            conn.close()
+        self.outgoing = {}
+        for mux in self.muxes.values():
+            mux['writer'].close()
+            for peer in mux['jobs']:
+                peer.close()
+        self.muxes = {}
+        for stream in self.streams.values():
+            for sock in (stream['conn'], stream['writer'], stream['peer']):
+                if sock is not None:
+                    sock.close()
+            for fd in [stream['stdin']] + list(stream['outputs']):
+                if fd is not None:
+                    os.close(fd)
+        self.streams = {}
+        # As are the connections to other workers' clients
+        for child in self.children.values():
+            child['conn'].close()
+            if child['capture'] is not None:
+                child['capture'].close()
+        self.children = {}
+        self.siblings = {}
+        self.pool_size = 0
 
+    def _setup_env(self, argv, env, cwd, fds, tcp=False):
         print('[{}] cwd={} argv={} env_count={}'.format(os.getpid(), cwd, argv, len(env)), file=sys.stderr)
 
         # Python doesn't natively let you set your actual
@@ -175,75 +2232,145 @@ class Pyseidon(object):
         os.environ.clear()
         os.environ.update(env)
 
-        os.chdir(cwd)
+        cwd_error = None
+        try:
+            os.chdir(cwd)
+        except OSError as e:
+            # A TCP client's cwd (say, in its container) needn't exist
+            # here, so it runs in ours instead
+            if not tcp:
+                raise
+            cwd_error = e
 
         # Set up file descriptors
         stdin, stdout, stderr = fds
-        os.dup2(stdin.fileno(), 0)
-        os.dup2(stdout.fileno(), 1)
-        os.dup2(stderr.fileno(), 2)
-        stdin.close()
-        stdout.close()
-        stderr.close()
+        os.dup2(stdin, 0)
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        for fd in fds:
+            if fd > 2:
+                os.close(fd)
+
+        if cwd_error is not None:
+            # Now that it goes to the client
+            print('[{}] Could not change directory to {}: {}; running in {} instead'.format(os.getpid(), cwd.decode('utf-8', 'replace'), cwd_error.strerror, os.getcwd()), file=sys.stderr)
+
+    def _job_limits(self, handshake):
+        # Clients can ask for tighter limits than run() set, but not
+        # looser ones
+        limits = {}
+        for name in _LIMITS:
+            value = handshake.options.get(name + '_limit')
+            if value is None:
+                value = handshake.env.get('POSEIDON_{}_LIMIT'.format(name.upper()).encode('utf-8'), b'').decode('utf-8', 'replace')
+            if value:
+                parsed = _parse_limit(name, value)
+                if parsed is None:
+                    print('[{}] Ignoring bad {} limit: {!r}'.format(os.getpid(), name, value), file=sys.stderr)
+                value = parsed
+            else:
+                value = None
+            ceiling = self.limits.get(name)
+            if ceiling is not None:
+                value = ceiling if value is None else min(value, ceiling)
+            if value is not None:
+                limits[name] = value
+        return limits
+
+    def _apply_limits(self, limits):
+        # The master sees to the wall limit
+        for name, value in limits.items():
+            if name == 'wall':
+                continue
+            try:
+                _lower_rlimit(_RLIMITS[name], value)
+            except (ValueError, OverflowError, OSError) as e:
+                print('[{}] Could not apply {} limit of {}: {}'.format(os.getpid(), name, value, e), file=sys.stderr)
+
+    def _start_capture(self, capture_fd, limit):
+        # Tee stdout and stderr through pipes, so the client sees
+        # output as it's written and we keep a copy for the cache.
+        self.capture = {'fd': capture_fd, 'streams': []}
+        for fd in (1, 2):
+            r, w = os.pipe()
+            target = os.dup(fd)
+            os.dup2(w, fd)
+            os.close(w)
+            captured = [bytearray()]
+            thread = threading.Thread(target=_tee, args=(r, target, captured, limit))
+            thread.daemon = True
+            thread.start()
+            self.capture['streams'].append({'thread': thread, 'target': target, 'captured': captured})
+
+    def _finish_capture(self, status):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Pointing stdout and stderr straight at the client again
+        # closes our ends of the pipes, which lets the tees finish.
+        # Anything printed from here on (say, a traceback) isn't
+        # captured.
+        for fd, stream in zip((1, 2), self.capture['streams']):
+            os.dup2(stream['target'], fd)
+
+        outputs = []
+        for stream in self.capture['streams']:
+            # Something we spawned may still hold the pipe open; don't
+            # wait on it forever, and don't cache partial output.
+            stream['thread'].join(1)
+            if stream['thread'].is_alive():
+                outputs = None
+                break
+            os.close(stream['target'])
+            outputs.append(stream['captured'][0])
+
+        # An empty capture file tells the master not to cache
+        if outputs is not None and None not in outputs:
+            stdout, stderr = outputs
+            data = struct.pack('<QQi', len(stdout), len(stderr), status) + stdout + stderr
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.capture['fd'], view):]
+        os.close(self.capture['fd'])
+
+    def _store_result(self, child, status):
+        capture = child['capture']
+        capture.seek(0)
+        data = capture.read()
+        capture.close()
+        if not data:
+            return
+        stdout_len, stderr_len, captured_status = struct.unpack_from('<QQi', data)
+        if captured_status != status:
+            # Exited some other way than the handler returning
+            return
+        offset = struct.calcsize('<QQi')
+        stdout = data[offset:offset + stdout_len]
+        stderr = data[offset + stdout_len:offset + stdout_len + stderr_len]
+        self.cache.put(child['cache_key'], stdout, stderr, status)
 
     def _is_master(self):
         return os.getpid() == self.master_pid
 
 
-    def _remove_socket(self):
-        # Don't worry about removing the socket if a worker exits
-        if not self._is_master():
+    def _remove_socket(self, path, owner):
+        # Don't worry about removing the socket if a worker (or
+        # another profile's master) exits
+        if os.getpid() != owner:
             return
 
         try:
-            os.unlink(self.path)
+            os.unlink(path)
         except OSError:
-            if os.path.exists(self.path):
+            if os.path.exists(path):
                 raise
 
-    def _read_argv(self, conn):
-        return self._read_array(conn)
-
-    def _read_env(self, conn):
-        env = {}
-        kv_pairs = self._read_array(conn)
-        for kv in kv_pairs:
-            k, v = kv.split(b'=', 1)
-            env[k] = v
-        return env
-
-    def _read_array(self, conn):
-        argc_packed = conn.recv(4)
-        argc, = struct.unpack('I', argc_packed)
-
-        argv = []
-        for i in range(argc):
-            line = _recvline(conn, b'\0')
-            if line[-1:] != b'\0':
-                raise RuntimeError("Corrupted array; not null terminated: {}".format(line))
-            argv.append(line.rstrip(b'\0'))
-
-        return argv
-
-    def _read_cwd(self, conn):
-        line = _recvline(conn, b'\0')
-        if line[-1:] != b'\0':
-            raise RuntimeError("Corrupted cwd; not null terminated: {}".format(line))
-        return line.rstrip(b'\0')
-
-    def _read_fds(self, conn):
-        stdin = os.fdopen(_recvfd(conn))
-        stdout = os.fdopen(_recvfd(conn), 'w')
-        stderr = os.fdopen(_recvfd(conn), 'w')
-        return stdin, stdout, stderr
-
     def _break_loop(self, signum, stack):
         try:
             self.loopbreak_writer.write(b'a')
         except IOError as e:
             # The pipe is full. This is surprising, but could happen
             # in theory if we're being spammed with dying children.
-            if t.errno == errno.EAGAIN:
+            if e.errno == errno.EAGAIN:
                 return
             else:
                 raise
@@ -251,38 +2378,11 @@ class Pyseidon(object):
     def _reap(self):
         try:
             while True:
-                pid, exitinfo = os.waitpid(-1, os.WNOHANG)
+                pid, exitinfo, rusage = os.wait4(-1, os.WNOHANG)
                 if pid == 0:
                     # Just means there's an extra child hanging around
                     break
-
-                signal = exitinfo % 2**8
-                status = exitinfo >> 8
-                if signal:
-                    print('[{}] Worker {} exited due to signal {}'.format(os.getpid(), pid, signal), file=sys.stderr)
-                    # In this case, we'll just have the client exit
-                    # with an arbitrary status 100.
-                    client_exit = 100
-                else:
-                    if pid in self.children:
-                        print('[{}] Worker {} exited with status {}'.format(os.getpid(), pid, status), file=sys.stderr)
-                    else:
-                        print('[{}] Non-worker child process {} exited with status {}'.format(os.getpid(), pid, status), file=sys.stderr)
-                        continue
-                    client_exit = status
-                conn = self.children[pid]['conn']
-                try:
-                    # TODO: make this non-blocking
-                    conn.send(struct.pack('I', client_exit))
-                except socket.error as e:
-                    # Shouldn't care if the client has died in the
-                    # meanwhile. Their loss!
-                    if e.errno == errno.EPIPE:
-                        pass
-                    else:
-                        raise
-                conn.close()
-                del self.children[pid]
+                self._handle_exit(pid, exitinfo, rusage)
         except OSError as e:
             # Keep going until we run out of dead workers
             if e.errno == errno.ECHILD:
@@ -290,22 +2390,425 @@ class Pyseidon(object):
             else:
                 raise
 
-    def run(self, callback):
-        # Install SIGCHLD handler so we know when workers exit
-        old = signal.signal(signal.SIGCHLD, self._break_loop)
+    def _handle_exit(self, pid, exitinfo, rusage):
+        # Anything the worker reported was sent before it exited
+        self._read_reports(self.report_reader)
+
+        signal = exitinfo % 2**8
+        status = exitinfo >> 8
+        if pid in self.pool:
+            print('[{}] Idle pooled worker {} exited unexpectedly: status={} signal={}'.format(os.getpid(), pid, status, signal), file=sys.stderr)
+            self.pool.pop(pid)['channel'].close()
+            return
+        if pid in self.siblings:
+            worker = self.siblings.pop(pid)['worker']
+            if status or signal:
+                print('[{}] Sibling {} of worker {} exited: status={} signal={}'.format(os.getpid(), pid, worker, status, signal), file=sys.stderr)
+            return
+        profile = self._profile_for_pid(pid)
+        if profile is not None:
+            print('[{}] Master for profile {!r} exited: status={} signal={}'.format(os.getpid(), profile['name'], status, signal), file=sys.stderr)
+            self._fail_profile(profile)
+            return
+        if pid not in self.children:
+            print('[{}] Non-worker child process {} exited with status {}'.format(os.getpid(), pid, status), file=sys.stderr)
+            return
+        self._record_exit(self.children[pid], signal, rusage)
+        usage = (signal & 0x7F, time.monotonic() - self.children[pid]['spawned_at'], rusage.ru_utime + rusage.ru_stime, _maxrss_bytes(rusage))
+        if signal:
+            print('[{}] Worker {} exited due to signal {}'.format(os.getpid(), pid, signal), file=sys.stderr)
+            # In this case, we'll just have the client exit
+            # with an arbitrary status 100.
+            client_exit = 100
+        else:
+            print('[{}] Worker {} exited with status {}'.format(os.getpid(), pid, status), file=sys.stderr)
+            client_exit = status
+        child = self.children.pop(pid)
+        conn = child['conn']
+        if not child['notified']:
+            self._remove_reader(conn)
+        if child['capture'] is not None:
+            if signal:
+                child['capture'].close()
+            else:
+                self._store_result(child, status)
+        self._send_result(conn, child['version'], client_exit, usage)
+
+    def _profile_for_pid(self, pid):
+        for profile in self.profiles.values():
+            if profile['pid'] == pid:
+                return profile
+        return None
+
+    def _fail_profile(self, profile):
+        # Clients it already took went down with it; fail the ones
+        # still waiting here, and any that ask for it from now on.
+        if profile['writing']:
+            self._remove_writer(profile['channel'])
+            profile['writing'] = False
+        for entry in profile['backlog']:
+            if entry['conn'] is not None:
+                for fd in entry['fds']:
+                    os.close(fd)
+                self._send_result(entry['conn'], entry['version'], 100)
+        profile['backlog'].clear()
+        if profile['channel'] is not None:
+            profile['channel'].close()
+            profile['channel'] = None
+        profile['pid'] = None
+
+    def _record_exit(self, child, signal, rusage):
+        self.stats.observe('request_seconds', time.monotonic() - child['accepted_at'])
+        self.stats.observe('worker_cpu_seconds', rusage.ru_utime + rusage.ru_stime)
+        self.stats.observe('worker_maxrss_bytes', _maxrss_bytes(rusage), buckets=MEMORY_BUCKETS)
+        if signal:
+            self.stats.incr('worker_signals_total')
+
+    def _send_result(self, conn, version, status, usage=None):
+        self.outgoing[conn] = memoryview(_pack_result(version, status, usage))
+        self._flush_result(conn, registered=False)
+
+    def _flush_result(self, conn, registered=True):
+        # conn is non-blocking, so a client that isn't reading can't
+        # hold up the master; the rest goes out when it's writable.
+        out = self.outgoing[conn]
+        try:
+            out = out[conn.send(out):]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except socket.error as e:
+            # Shouldn't care if the client has died in the
+            # meanwhile. Their loss!
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+            out = b''
+        if out:
+            self.outgoing[conn] = out
+            if not registered:
+                self._add_writer(conn, self._flush_result)
+            return
+        if registered:
+            self._remove_writer(conn)
+        del self.outgoing[conn]
+        conn.close()
+
+    def _report_memory_usage(self):
+        usage = _memory_usage()
+        if usage is None:
+            return
+        self._report({'type': 'memory', 'pid': os.getpid(), 'usage': usage})
+
+    def _listen_control(self, path):
+        self.control_sock = self._bind(path, 16)
+        self._add_reader(self.control_sock, self._accept_control)
+
+    def _accept_control(self, sock):
+        try:
+            conn, _ = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        self.control_conns[conn] = bytearray()
+        self._add_reader(conn, self._read_control)
+
+    def _read_control(self, conn):
+        # Just enough HTTP to be scraped: GET /metrics gets the
+        # Prometheus text format, anything else gets JSON.
+        try:
+            data = conn.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        buf = self.control_conns[conn]
+        buf += data
+        if data and b'\n' not in buf and len(buf) < _MAX_CONTROL_REQUEST:
+            return
+        self._remove_reader(conn)
+
+        request_line = bytes(buf).split(b'\n', 1)[0].split()
+        path = request_line[1] if len(request_line) > 1 else b'/'
+        self._update_gauges()
+        if path.startswith(b'/metrics'):
+            body, content_type = self.stats.to_prometheus(), 'text/plain; version=0.0.4'
+        else:
+            body, content_type = self.stats.to_json(), 'application/json'
+        body = body.encode('utf-8')
+        response = 'HTTP/1.0 200 OK\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(content_type, len(body)).encode('utf-8') + body
+        self.control_conns[conn] = memoryview(response)
+        self._add_writer(conn, self._write_control)
+
+    def _write_control(self, conn):
+        out = self.control_conns[conn]
+        try:
+            out = out[conn.send(out):]
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            out = b''
+        self.control_conns[conn] = out
+        if not out:
+            self._remove_writer(conn)
+            del self.control_conns[conn]
+            conn.close()
+
+    def _update_gauges(self):
+        self.stats.set('workers', len(self.children))
+        self.stats.set('pool_idle', len(self.pool))
+        self.stats.set('handshakes_in_progress', len(self.handshakes))
+        self.stats.set('in_process_running', self.in_process_running)
+        self.stats.set('queued', sum(1 for _, _, entry in self.queue if not entry['dropped']))
+        if self.cache is not None:
+            self.stats.set('cache_entries', len(self.cache.entries))
+            self.stats.set('cache_bytes', self.cache.bytes)
+
+    def run(self, callback, pool_size=0, freeze_gc=False, gc_threshold=None, report_memory=False, cache=None, stats_path=None, max_workers=None, min_available_memory=None, backlog=socket.SOMAXCONN, reload=False, reload_interval=1.0, import_profile=None, threads=None, boot_profile=None, tcp=None, tcp_token=None, limits=None):
+        """Serve clients forever, running callback in a worker for each.
+
+        With pool_size, that many workers are forked ahead of time and
+        park until a client arrives, taking fork() off the path the
+        client waits on. The pool is topped back up as it's used.
+
+        freeze_gc moves everything preloaded so far into the
+        collector's permanent generation (gc.freeze) before serving,
+        so workers don't un-share those pages just by collecting.
+        gc_threshold is passed to gc.set_threshold at the same point.
+        report_memory makes each worker log its shared and private
+        memory to the master's stderr as it exits.
+
+        cache, a pyseidon.cache.ResultCache, lets the master answer
+        repeated invocations from captured output without forking.
+        Clients opt in per invocation by setting POSEIDON_CACHE_INPUTS.
+
+        stats_path is a UNIX socket serving latency, CPU and memory
+        histograms over HTTP: /metrics in Prometheus text format,
+        anything else as JSON.
+
+        max_workers caps how many workers run at once, and
+        min_available_memory (in bytes, checked against MemAvailable)
+        holds off forking while the box is short on memory. Clients
+        beyond either limit wait in a queue, highest priority
+        (POSEIDON_PRIORITY, default 0) first, then in arrival order.
+        backlog is passed to listen().
+
+        With reload, modules are watched for changes (by polling their
+        mtimes every reload_interval seconds): reload=True covers all
+        preloaded modules from outside the standard library and
+        site-packages, or pass a list of module names. On a change, a
+        new master is forked from this process as it was before
+        serving, re-imports just the changed modules and re-runs
+        profile setup. It takes over the sockets once it's ready; the
+        old master stops accepting and exits when its workers finish.
+        callback, and profiles' setup and handler, are looked up again
+        by name in the new master, so they should be module-level.
+
+        import_profile, a pyseidon.imports.ImportProfile, records the
+        modules workers import for themselves and how long they take,
+        and has the master preload them when it next boots (or in the
+        next generation, with reload). Each profile keeps its own.
+
+        With threads, a handler marked with pyseidon.in_process runs
+        in the master itself on that many threads, without forking. See
+        pyseidon.inprocess.
+
+        boot_profile, a pyseidon.imports.BootProfile, gets the time and
+        memory taken by each import and setup step so far, and run()'s
+        own, written out before serving.
+
+        Clients can have the handler run under cProfile by setting
+        POSEIDON_CPROFILE to a file to write the profile to (relative
+        to their working directory), or to - to have the top functions
+        printed to their stderr. Either way, how long the request took
+        to reach the handler is printed too.
+
+        tcp, a (host, port), also takes clients over TCP, for those
+        that can't reach the UNIX socket. They must send tcp_token.
+        Their stdin, stdout and stderr are relayed over the connection
+        rather than passed to the worker.
+
+        limits caps what each worker may use: a dict of cpu (seconds of
+        CPU time), wall (seconds), memory (bytes of address space,
+        including what it shares with the master) and files (open
+        FDs). Clients can ask for lower limits for their own job with
+        POSEIDON_CPU_LIMIT and so on. A worker over its CPU limit is
+        sent SIGXCPU; one over its wall limit is killed. Results tell
+        v2 clients how the worker exited and what it used.
+        """
+        self._configure(pool_size, freeze_gc, gc_threshold, report_memory, cache, max_workers, min_available_memory, import_profile, boot_profile, limits)
+        # Each worker gets a pidfd in the event loop where the kernel
+        # supports it, so an exit costs one wait4 on a known pid.
+        # Otherwise, install SIGCHLD handler so we know when workers
+        # exit.
+        self.use_pidfd = use_pidfd = _pidfd_supported()
+        if not use_pidfd:
+            old = signal.signal(signal.SIGCHLD, self._break_loop)
         # Start listening on the UNIX socket
-        self._listen()
+        self._listen(backlog)
+        if stats_path is not None:
+            self._listen_control(stats_path)
+        if tcp is not None:
+            self._listen_tcp(tcp, tcp_token, backlog)
+        for profile in self.profiles.values():
+            if profile['path'] is not None:
+                profile['sock'] = self._bind(profile['path'], backlog)
+
+        if reload:
+            # Only returns in a generation's master
+            changed = self._serve_generations(reload, reload_interval)
+            if changed:
+                callback = _resolve(callback)
+                for profile in self.profiles.values():
+                    for key in ('setup', 'handler'):
+                        if profile[key] is not None:
+                            profile[key] = _resolve(profile[key])
+        # Returns in each profile's master, too, once it's set up
+        self._start_profiles()
+        if self.profile is not None and self.profile['handler'] is not None:
+            handler = self.profile['handler']
+        else:
+            handler = callback
+        if threads and pyseidon.inprocess.is_in_process(handler):
+            self._start_in_process(handler, threads)
+        self._check_ready()
 
         # And do the actual workhorse
         self._run_event_loop()
 
         # Get rid of that handler
-        signal.signal(signal.SIGCHLD, old)
+        if not use_pidfd:
+            signal.signal(signal.SIGCHLD, old)
         # In theory we might add the ability for the master to
         # gracefully exit.
         if self._is_master():
             return
 
         # Guess we're in a worker process.
-        callback()
+        if self.profile is not None and self.profile['handler'] is not None:
+            callback = self.profile['handler']
+        self._serve_worker(callback)
         sys.exit(0)
+
+    async def serve_async(self, callback, pool_size=0, freeze_gc=False, gc_threshold=None, report_memory=False, cache=None, stats_path=None, max_workers=None, min_available_memory=None, backlog=socket.SOMAXCONN, import_profile=None, threads=None, boot_profile=None, tcp=None, tcp_token=None, limits=None):
+        """Serve clients from the running asyncio event loop, alongside
+        whatever else it's doing, until cancelled.
+
+        Takes the same options as run(), except for profiles and
+        reload, which need a process to themselves. Workers are forked
+        from within the loop and never return to it: they run callback
+        and exit straight away, without running atexit handlers. Once
+        cancelled, no new clients are accepted, but running workers are
+        seen through as long as the loop keeps going.
+        """
+        import asyncio
+
+        if self.profiles:
+            raise ValueError('Profiles need run(), not serve_async()')
+        self._configure(pool_size, freeze_gc, gc_threshold, report_memory, cache, max_workers, min_available_memory, import_profile, boot_profile, limits)
+        loop = asyncio.get_running_loop()
+        self._adopt_loop(loop)
+        self.async_callback = callback
+        self.use_pidfd = _pidfd_supported()
+        if not self.use_pidfd:
+            loop.add_signal_handler(signal.SIGCHLD, self._reap_known)
+        self._listen(backlog)
+        if stats_path is not None:
+            self._listen_control(stats_path)
+        if tcp is not None:
+            self._listen_tcp(tcp, tcp_token, backlog)
+        if threads and pyseidon.inprocess.is_in_process(callback):
+            self._start_in_process(callback, threads)
+        self._after_async()
+
+        try:
+            await loop.create_future()
+        finally:
+            for sock in (self.sock, self.control_sock, self.tcp_sock):
+                if sock is not None:
+                    self._remove_reader(sock)
+            self._close_listeners()
+            print('[{}] Pyseidon master stopped accepting clients'.format(os.getpid()), file=sys.stderr)
+
+    def _configure(self, pool_size, freeze_gc, gc_threshold, report_memory, cache, max_workers, min_available_memory, import_profile, boot_profile, limits):
+        unknown = set(limits or {}) - set(_LIMITS)
+        if unknown:
+            raise ValueError('Unknown limits: {}'.format(', '.join(sorted(unknown))))
+        for name, value in (limits or {}).items():
+            if _parse_limit(name, value) != value:
+                raise ValueError('Bad {} limit: {!r}'.format(name, value))
+        self.limits = dict(limits or {})
+        self.pool_size = pool_size
+        self.freeze_gc = freeze_gc
+        self.report_memory = report_memory
+        self.cache = cache
+        self.max_workers = max_workers
+        self.min_available_memory = min_available_memory
+        self.import_profile = import_profile
+        if boot_profile is not None:
+            step = boot_profile.step
+        else:
+            step = lambda name: contextlib.nullcontext()
+        if import_profile is not None:
+            with step('preload imports'):
+                self._preload_imports()
+        if gc_threshold is not None:
+            gc.set_threshold(*gc_threshold)
+        if freeze_gc:
+            with step('freeze gc'):
+                # Clean up garbage first so it isn't frozen forever
+                gc.collect()
+                gc.freeze()
+        if boot_profile is not None:
+            boot_profile.save()
+
+    def _serve_worker(self, callback):
+        if self.import_profile is not None:
+            preloaded = set(sys.modules)
+            timer = pyseidon.imports.ImportTimer()
+            timer.install()
+        self._report({'type': 'start', 'pid': os.getpid(), 'time': time.monotonic()})
+        status = 0
+        if self.cprofile is not None:
+            profiler = cProfile.Profile()
+            handler_start = time.monotonic()
+            profiler.enable()
+        try:
+            callback()
+        except SystemExit as e:
+            status = e.code
+            raise
+        finally:
+            if self.cprofile is not None:
+                profiler.disable()
+                self.cprofile['handler_seconds'] = time.monotonic() - handler_start
+            if self.capture is not None:
+                self._finish_capture(self._exit_status(status))
+            if self.cprofile is not None:
+                # After the capture, so it never ends up in the cache
+                self._write_cprofile(profiler)
+            if self.report_memory:
+                self._report_memory_usage()
+            if self.import_profile is not None:
+                self._report_imports(timer.new_modules(preloaded))
+
+    def _write_cprofile(self, profiler):
+        timing = self.cprofile
+        print('[{}] Timing: dispatch={:.1f}ms setup={:.1f}ms handler={:.1f}ms'.format(os.getpid(), timing['dispatch_seconds'] * 1000, timing['setup_seconds'] * 1000, timing['handler_seconds'] * 1000), file=sys.stderr)
+        if timing['path'] == '-':
+            # Straight back to the client
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(_CPROFILE_LINES)
+            return
+        try:
+            profiler.dump_stats(timing['path'])
+        except (IOError, OSError) as e:
+            print('[{}] Could not write profile to {}: {}'.format(os.getpid(), timing['path'], e), file=sys.stderr)
+        else:
+            print('[{}] Wrote profile to {}'.format(os.getpid(), timing['path']), file=sys.stderr)
+
+    def _exit_status(self, code):
+        # Mirror how the interpreter turns a SystemExit code into a
+        # process exit status
+        if code is None:
+            return 0
+        if isinstance(code, int):
+            return code & 0xFF
+        return 1
@@ -0,0 +1,101 @@
+import collections
+import hashlib
+import os
+
+# Clients opt an invocation into caching by setting this in their
+# environment, to a colon-separated list of input files the output
+# depends on (possibly empty). Anything not in argv, cwd, the listed
+# env_keys or those files -- stdin in particular -- is assumed not to
+# matter.
+INPUTS_ENV = b'POSEIDON_CACHE_INPUTS'
+
+class ResultCache(object):
+    """Size-bounded LRU cache of finished invocations.
+
+    Values are the captured stdout and stderr bytes plus the exit
+    status. Keys cover argv (bar argv[0]), cwd, the environment variables named in
+    env_keys and the mtime and size (or, with hash_inputs, a hash of
+    the contents) of each declared input file.
+
+    Keys are worked out in the master's event loop, so hashing holds
+    up every other client. At most max_hash_bytes are hashed per
+    invocation; inputs past that are keyed by mtime and size.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, env_keys=(), hash_inputs=False, max_hash_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.env_keys = [k.encode('utf-8') if isinstance(k, str) else k for k in env_keys]
+        self.hash_inputs = hash_inputs
+        self.max_hash_bytes = max_hash_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def is_cacheable(self, env):
+        return INPUTS_ENV in env
+
+    def key(self, argv, env, cwd):
+        inputs = []
+        budget = self.max_hash_bytes
+        for path in env.get(INPUTS_ENV, b'').split(b':'):
+            if not path:
+                continue
+            path = os.path.join(cwd, path)
+            fingerprint, hashed = self._fingerprint(path, budget)
+            budget -= hashed
+            inputs.append((path, fingerprint))
+        return (
+            # argv[0] is just how the client was run, which handlers
+            # never see
+            tuple(argv[1:]),
+            tuple((k, env.get(k)) for k in self.env_keys),
+            cwd,
+            tuple(inputs),
+        )
+
+    def _fingerprint(self, path, budget):
+        # Returns the fingerprint, and how many bytes were read for it
+        hashed = 0
+        try:
+            st = os.stat(path)
+            if self.hash_inputs and st.st_size <= budget:
+                digest = hashlib.sha1()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(min(1024 * 1024, budget - hashed + 1)), b''):
+                        hashed += len(chunk)
+                        if hashed > budget:
+                            # It grew under us
+                            break
+                        digest.update(chunk)
+                    else:
+                        return digest.hexdigest(), hashed
+            return (st.st_mtime_ns, st.st_size), hashed
+        except (IOError, OSError):
+            # A missing input is part of the key, too
+            return None, hashed
+
+    def get(self, key):
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, stdout, stderr, status):
+        size = len(stdout) + len(stderr)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            old = self.entries.pop(key)
+            self.bytes -= len(old[0]) + len(old[1])
+        self.entries[key] = (stdout, stderr, status)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (old_stdout, old_stderr, _) = self.entries.popitem(last=False)
+            self.bytes -= len(old_stdout) + len(old_stderr)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
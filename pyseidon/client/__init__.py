@@ -0,0 +1,347 @@
+"""
+Run jobs on a Pyseidon master straight from Python, without a client
+process per job.
+
+All jobs go over one connection to the master, as many at a time as
+you like, and come back as futures:
+
+```
+import pyseidon.client
+
+with pyseidon.client.Client() as client:
+    futures = [client.submit(['train.py', str(seed)], capture=True) for seed in range(1000)]
+    for future in futures:
+        result = future.result()
+        print(result.status, result.stdout)
+```
+
+or, from a coroutine, as they finish:
+
+```
+async for result in client.results(futures):
+    ...
+```
+
+A job's stdin is /dev/null and its stdout and stderr are ours, unless
+given other FDs (or file objects), which must stay open until it
+finishes. With capture, its stdout and stderr are collected instead.
+"""
+import array
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import os
+import selectors
+import socket
+import struct
+import threading
+
+import pyseidon
+
+# signal (0 if none), wall_seconds, cpu_seconds and maxrss_bytes are
+# None for jobs that weren't run by a worker (say, cache hits)
+Result = collections.namedtuple('Result', ['job', 'args', 'status', 'stdout', 'stderr', 'signal', 'wall_seconds', 'cpu_seconds', 'maxrss_bytes'])
+
+# Handlers never see argv[0], but the protocol has room for it
+_ARGV0 = b'pyseidon'
+_JOB_RESULT = struct.Struct('<IQ')
+
+def _encode(value):
+    return value if isinstance(value, bytes) else os.fsencode(value)
+
+def _fileno(f):
+    return f if isinstance(f, int) else f.fileno()
+
+def _pack_request(args, env, cwd, options):
+    payload = [struct.pack('<I', len(args) + 1), _ARGV0, b'\0']
+    for arg in args:
+        payload += [_encode(arg), b'\0']
+    payload.append(struct.pack('<I', len(env)))
+    for k, v in env.items():
+        payload += [_encode(k), b'=', _encode(v), b'\0']
+    payload += [_encode(cwd), b'\0']
+    for k, v in options.items():
+        payload += ['{}={}'.format(k, v).encode('utf-8'), b'\0']
+    payload = b''.join(payload)
+    return pyseidon._V2_HEADER.pack(pyseidon.PROTOCOL_MAGIC, pyseidon.PROTOCOL_VERSION, 0, len(payload)) + payload
+
+class Client(object):
+    """A connection to the master at path (by default, $POSEIDON_SOCK
+    or /tmp/pyseidon.sock). Safe to share between threads."""
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('POSEIDON_SOCK', '/tmp/pyseidon.sock')
+        # Reentrant, since futures' callbacks run with it held
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        # Unfinished jobs, by id
+        self.jobs = {}
+        # The connection new jobs go out on; connected when first needed
+        self.conn = None
+        self.closed = False
+        self.devnull = os.open(os.devnull, os.O_RDONLY)
+
+        # Everything is read on one thread; other threads hand it new
+        # things to watch through this queue.
+        self.selector = selectors.DefaultSelector()
+        self.pending = collections.deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._serve, name='pyseidon-client')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, args, env=None, cwd=None, stdin=None, stdout=None, stderr=None, capture=False, options=None):
+        """Start running args (sys.argv in the worker) and return a
+        future for its Result. options are extra protocol options, such
+        as priority or profile."""
+        job = {
+            'id': next(self.ids),
+            'args': list(args),
+            'future': concurrent.futures.Future(),
+            'status': None,
+            'usage': (None,) * 4,
+            # Our write ends of its capture pipes, held until it's
+            # answered in case it has to be sent again
+            'pipes': [],
+            'captured': None,
+            'open': 0,
+        }
+        job['future'].set_running_or_notify_cancel()
+        fds = [
+            self.devnull if stdin is None else _fileno(stdin),
+            1 if stdout is None else _fileno(stdout),
+            2 if stderr is None else _fileno(stderr),
+        ]
+        if capture:
+            job['captured'] = [bytearray(), bytearray()]
+            job['readers'] = []
+            for i in (1, 2):
+                r, w = os.pipe()
+                fds[i] = w
+                job['pipes'].append(w)
+                job['readers'].append(r)
+            job['open'] = 2
+        job['fds'] = fds
+        options = dict(options or {}, job=job['id'])
+        job['request'] = _pack_request(job['args'], os.environ if env is None else env, os.getcwd() if cwd is None else cwd, options)
+
+        with self.lock:
+            try:
+                if self.closed:
+                    raise ValueError('Client is closed')
+                self._send(job)
+            except BaseException:
+                self._close_pipes(job)
+                for fd in job.get('readers', []):
+                    os.close(fd)
+                raise
+            self.jobs[job['id']] = job
+        if capture:
+            self._wake(('capture', job))
+        return job['future']
+
+    def run(self, args, **kwargs):
+        """Run args and wait for its Result."""
+        return self.submit(args, **kwargs).result()
+
+    def map(self, argvs, **kwargs):
+        """Run each of argvs at once, and return an iterator over their
+        Results in order."""
+        futures = [self.submit(args, **kwargs) for args in argvs]
+        return (future.result() for future in futures)
+
+    async def results(self, futures):
+        """Yield the Results of futures as they finish."""
+        for future in asyncio.as_completed([asyncio.wrap_future(future) for future in futures]):
+            yield await future
+
+    def close(self, wait=True):
+        """Hang up. Jobs still running are sent SIGHUP, as if their
+        client had gone away, unless wait is set, in which case they're
+        waited for first."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            futures = [job['future'] for job in self.jobs.values()]
+        if wait:
+            concurrent.futures.wait(futures)
+        self._wake(('close', None))
+        self.thread.join()
+
+    def _wake(self, item):
+        self.pending.append(item)
+        try:
+            self.wakeup_writer.send(b'a')
+        except BlockingIOError:
+            # It'll wake up anyway
+            pass
+
+    def _send(self, job):
+        # With the lock held
+        if self.conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except socket.error:
+                sock.close()
+                raise
+            self.conn = {'sock': sock, 'buf': bytearray(), 'jobs': set(), 'retiring': False}
+            self._wake(('conn', self.conn))
+        conn = self.conn
+        # Once it's on the connection's books, a job that fails to go
+        # out is dealt with along with the connection
+        conn['jobs'].add(job['id'])
+        try:
+            data = job['request']
+            # The FDs go along with the first byte
+            sent = conn['sock'].sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', job['fds']))])
+            if sent < len(data):
+                conn['sock'].sendall(data[sent:])
+        except socket.error:
+            pass
+
+    def _close_pipes(self, job):
+        # The read ends are closed once they've been read to the end
+        for fd in job['pipes']:
+            os.close(fd)
+        job['pipes'] = []
+
+    def _serve(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wakeup_reader:
+                    if not self._read_wakeup():
+                        return
+                elif key.data[0] == 'conn':
+                    self._read_conn(key.data[1])
+                else:
+                    self._read_capture(key.fileobj, *key.data[1:])
+
+    def _read_wakeup(self):
+        try:
+            self.wakeup_reader.recv(4096)
+        except BlockingIOError:
+            pass
+        while self.pending:
+            kind, value = self.pending.popleft()
+            if kind == 'conn':
+                self.selector.register(value['sock'], selectors.EVENT_READ, ('conn', value))
+            elif kind == 'capture':
+                for i, fd in enumerate(value['readers']):
+                    self.selector.register(fd, selectors.EVENT_READ, ('capture', value, i))
+            elif kind == 'close':
+                self._shut_down()
+                return False
+        return True
+
+    def _read_conn(self, conn):
+        try:
+            data = conn['sock'].recv(65536)
+        except socket.error:
+            data = b''
+        if not data:
+            self._lose_conn(conn)
+            return
+        buf = conn['buf']
+        buf += data
+        while len(buf) >= _JOB_RESULT.size:
+            length, job_id = _JOB_RESULT.unpack_from(buf)
+            if len(buf) < length + 4:
+                break
+            status, = struct.unpack_from('<i', buf, _JOB_RESULT.size)
+            usage = (None,) * 4
+            # length covers the job id and status, too
+            if length - 12 >= pyseidon._RESULT_USAGE.size:
+                usage = pyseidon._RESULT_USAGE.unpack_from(buf, _JOB_RESULT.size + 4)
+            del buf[:length + 4]
+            with self.lock:
+                if job_id == 0:
+                    # The master's retiring this connection (say, for a
+                    # newer generation); new jobs go out on another
+                    conn['retiring'] = True
+                    if self.conn is conn:
+                        self.conn = None
+                    continue
+                conn['jobs'].discard(job_id)
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                job['status'] = status
+                job['usage'] = usage
+                self._close_pipes(job)
+                self._check_done(job)
+
+    def _lose_conn(self, conn):
+        self.selector.unregister(conn['sock'])
+        conn['sock'].close()
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+            for job_id in conn['jobs']:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                if conn['retiring'] and not self.closed:
+                    # It never took these, so they can go elsewhere
+                    try:
+                        self._send(job)
+                        continue
+                    except socket.error as e:
+                        error = e
+                else:
+                    error = ConnectionError('Master hung up connection')
+                del self.jobs[job_id]
+                self._close_pipes(job)
+                job['future'].set_exception(error)
+
+    def _read_capture(self, fd, job, i):
+        data = os.read(fd, 65536)
+        if data:
+            job['captured'][i] += data
+            return
+        self.selector.unregister(fd)
+        os.close(fd)
+        with self.lock:
+            job['open'] -= 1
+            self._check_done(job)
+
+    def _check_done(self, job):
+        # With the lock held
+        if job['status'] is None or job['open']:
+            return
+        if self.jobs.pop(job['id'], None) is None:
+            return
+        stdout = stderr = None
+        if job['captured'] is not None:
+            stdout, stderr = (bytes(output) for output in job['captured'])
+        job['future'].set_result(Result(job['id'], job['args'], job['status'], stdout, stderr, *job['usage']))
+
+    def _shut_down(self):
+        # Hanging up has the master HUP anything still running
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None and key.data[0] == 'conn':
+                key.fileobj.close()
+            elif key.data is not None:
+                os.close(key.fileobj)
+        self.selector.close()
+        with self.lock:
+            if self.conn is not None:
+                self.conn['sock'].close()
+                self.conn = None
+            for job in self.jobs.values():
+                self._close_pipes(job)
+                job['future'].set_exception(ConnectionError('Client closed'))
+            self.jobs = {}
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+        os.close(self.devnull)
@@ -1,12 +1,20 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <errno.h>
+#include <fcntl.h>
+#include <netdb.h>
+#include <poll.h>
 #include <stdio.h>
 #include <string.h>
+#include <time.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
+#include <sys/file.h>
 #include <sys/param.h>
 #include <sys/types.h>
 #include <sys/socket.h>
 #include <sys/un.h>
+#include <sys/wait.h>
 #include <unistd.h>
 
 extern char **environ;
@@ -105,24 +113,65 @@ int checked_sendfd(int s, int fd)
   return 0;
 }
 
-int main(int argc, char **argv)
+// Must match PROTOCOL_MAGIC/PROTOCOL_VERSION in pyseidon/__init__.py
+#define PROTOCOL_MAGIC "PSDN"
+#define PROTOCOL_VERSION 2
+
+// Over TCP, stdio goes over the connection as frames: a type (the
+// stream's FD number, or FRAME_EXIT for the result) and a payload
+// length. Must match _STREAM_FRAME in pyseidon/__init__.py
+#define FRAME_HEADER 5
+#define FRAME_EXIT 3
+#define STREAM_CHUNK (256 * 1024)
+
+// A v2 result can carry, after the exit status, the signal that killed
+// the worker, its wall and CPU seconds (as doubles) and its peak RSS in
+// bytes. Must match _RESULT_USAGE in pyseidon/__init__.py
+#define RESULT_SIZE (4 + 4 + 8 + 8 + 8)
+
+#ifndef MSG_NOSIGNAL
+#define MSG_NOSIGNAL 0
+#endif
+
+void checked_recv(int s, void *buffer, int length)
 {
-  char *sock_path = getenv("POSEIDON_SOCK");
-  if (!sock_path)
-    sock_path = "/tmp/pyseidon.sock";
+  int t, total = 0;
 
-  int s;
-  if ((s = socket(AF_UNIX, SOCK_STREAM, 0)) < 0) {
-    handle_error("Could not create socket");
+  // Maybe should replace this janky buffering with fread or
+  // something.
+  while (total < length) {
+    // Handle errors as well as closed other ends
+    if ((t = recv(s, (char *)buffer + total, length - total, 0)) < 0) {
+      handle_error("Could not receive exitstatus from master");
+    } else if (t == 0) {
+      handle_error("Master hung up connection");
+    }
+    total += t;
   }
+}
 
-  struct sockaddr_un remote;
-  remote.sun_family = AF_UNIX;
-  strncpy(remote.sun_path, sock_path, sizeof(remote.sun_path)-1);
-  if (connect(s, (struct sockaddr *) &remote, sizeof(remote)) < 0) {
-    handle_error("Could not connect to UNIX socket for master process");
+char *get_cwd()
+{
+  int size = 0;
+  if ((size = pathconf(".", _PC_PATH_MAX)) < 0) {
+    handle_error("Could not determine file system's maximum path length");
+  }
+
+  char *buf;
+  if ((buf = (char *)malloc((size_t)size)) == NULL) {
+    handle_error("Could not allocate enough memory to store current working directory");
+  }
+
+  if (getcwd(buf, size) == NULL) {
+    handle_error("Could not determine current working directory");
   }
+  return buf;
+}
 
+// v1: one send per string, one sendmsg per FD. Kept for talking to
+// masters that predate v2.
+void send_request_v1(int s, int argc, char **argv, int env_size, char *cwd)
+{
   // WRITE: argument count
   checked_send_int(s, argc);
 
@@ -132,10 +181,6 @@ int main(int argc, char **argv)
   }
 
   // WRITE: environment variable count
-  int env_size = 0;
-  while (environ[env_size] != NULL) {
-    env_size++;
-  }
   checked_send_int(s, env_size);
 
   for (int i = 0; i < env_size; i++) {
@@ -144,40 +189,544 @@ int main(int argc, char **argv)
   }
 
   // WRITE: cwd
-  int size = 0;
-  if ((size = pathconf(".", _PC_PATH_MAX)) < 0) {
-    handle_error("Could not determine file system's maximum path length");
+  checked_send(s, cwd, strlen(cwd)+1);
+
+  // Finally, send over the FDs
+  checked_sendfd(s, 0);
+  checked_sendfd(s, 1);
+  checked_sendfd(s, 2);
+}
+
+char *append_string(char *p, char *str)
+{
+  size_t len = strlen(str) + 1;
+  memcpy(p, str, len);
+  return p + len;
+}
+
+void send_all(int s, char *buf, size_t length)
+{
+  while (length > 0) {
+    ssize_t n = send(s, buf, length, MSG_NOSIGNAL);
+    if (n < 0) {
+      if (errno == EINTR)
+        continue;
+      handle_error("Could not send request");
+    }
+    buf += n;
+    length -= n;
   }
+}
 
+// v2: the whole request is framed into one buffer and sent with a
+// single sendmsg carrying all three FDs. Over TCP (with a token),
+// there are no FDs to send, and the token goes first, so the master
+// can check it before reading any further.
+void send_request_v2(int s, int argc, char **argv, int env_size, char *cwd, char *token)
+{
+  size_t payload_size = 4 + 4 + strlen(cwd) + 1;
+  size_t token_size = token ? 4 + strlen(token) : 0;
+  for (int i = 0; i < argc; i++) {
+    payload_size += strlen(argv[i]) + 1;
+  }
+  for (int i = 0; i < env_size; i++) {
+    payload_size += strlen(environ[i]) + 1;
+  }
+
+  size_t total = token_size + 12 + payload_size;
   char *buf;
-  if ((buf = (char *)malloc((size_t)size)) == NULL) {
-    handle_error("Could not allocate enough memory to store current working directory");
+  if ((buf = (char *)malloc(total)) == NULL) {
+    handle_error("Could not allocate enough memory to store request");
   }
-  
-  if (getcwd(buf, size) == NULL) {
-    handle_error("Could not determine current working directory");
+  char *p = buf;
+
+  if (token) {
+    // WRITE: the token, length first
+    pack_int((unsigned char *)p, strlen(token));
+    memcpy(p + 4, token, strlen(token));
+    p += token_size;
+  }
+
+  // WRITE: header (magic, version, flags, payload length)
+  memcpy(p, PROTOCOL_MAGIC, 4);
+  p[4] = PROTOCOL_VERSION & 0xFF;
+  p[5] = (PROTOCOL_VERSION >> 8) & 0xFF;
+  p[6] = 0;
+  p[7] = 0;
+  pack_int((unsigned char *)p + 8, payload_size);
+  p += 12;
+
+  // WRITE: argv, env, cwd
+  pack_int((unsigned char *)p, argc);
+  p += 4;
+  for (int i = 0; i < argc; i++) {
+    p = append_string(p, argv[i]);
+  }
+  pack_int((unsigned char *)p, env_size);
+  p += 4;
+  for (int i = 0; i < env_size; i++) {
+    p = append_string(p, environ[i]);
+  }
+  p = append_string(p, cwd);
+
+  if (token) {
+    send_all(s, buf, total);
+    free(buf);
+    return;
+  }
+
+  // WRITE: stdin, stdout, stderr, attached to the first byte
+  int fds[3] = {0, 1, 2};
+  struct iovec iov;
+  struct msghdr msg;
+  struct cmsghdr *cmsg;
+  char cms[CMSG_SPACE(sizeof(fds))];
+
+  iov.iov_base = buf;
+  iov.iov_len = total;
+
+  memset(&msg, 0, sizeof msg);
+  msg.msg_iov = &iov;
+  msg.msg_iovlen = 1;
+  msg.msg_control = (caddr_t)cms;
+  msg.msg_controllen = CMSG_LEN(sizeof(fds));
+
+  cmsg = CMSG_FIRSTHDR(&msg);
+  cmsg->cmsg_len = CMSG_LEN(sizeof(fds));
+  cmsg->cmsg_level = SOL_SOCKET;
+  cmsg->cmsg_type = SCM_RIGHTS;
+  memmove(CMSG_DATA(cmsg), fds, sizeof(fds));
+
+  ssize_t n;
+  if ((n = sendmsg(s, &msg, 0)) < 0) {
+    handle_error("Could not send request");
+  }
+  // A very large environment may not fit in the socket buffer in one
+  // go; the FDs went out with the first chunk either way.
+  if ((size_t)n < total) {
+    checked_send(s, buf + n, total - n);
   }
-  checked_send(s, buf, strlen(buf)+1);
   free(buf);
+}
 
-  // Finally, send over the FDs
-  checked_sendfd(s, 0);
-  checked_sendfd(s, 1);
-  checked_sendfd(s, 2);
+// Returns the connected socket, or -1 with errno set.
+int try_connect(char *sock_path)
+{
+  int s;
+  if ((s = socket(AF_UNIX, SOCK_STREAM, 0)) < 0) {
+    handle_error("Could not create socket");
+  }
 
-  int t, total = 0;
-  unsigned char exitstatus[4];
+  struct sockaddr_un remote;
+  memset(&remote, 0, sizeof(remote));
+  remote.sun_family = AF_UNIX;
+  strncpy(remote.sun_path, sock_path, sizeof(remote.sun_path)-1);
+  if (connect(s, (struct sockaddr *) &remote, sizeof(remote)) < 0) {
+    int saved = errno;
+    close(s);
+    errno = saved;
+    return -1;
+  }
+  return s;
+}
 
-  // Maybe should replace this janky buffering with fread or
-  // something.
-  while (total < 4) {
-    // Handle errors as well as closed other ends
-    if ((t = recv(s, exitstatus + total, 4 - total, 0)) < 0) {
-      handle_error("Could not receive exitstatus from master");
-    } else if (t == 0) {
+unsigned long long unpack_u64(unsigned char bytes[8])
+{
+  unsigned long long output = 0;
+  for (int i = 7; i >= 0; i--) {
+    output = (output << 8) | bytes[i];
+  }
+  return output;
+}
+
+double unpack_double(unsigned char bytes[8])
+{
+  unsigned long long bits = unpack_u64(bytes);
+  double output;
+  memcpy(&output, &bits, sizeof(output));
+  return output;
+}
+
+// With POSEIDON_RUSAGE set, say what the worker used
+void print_usage(unsigned char *result, size_t length)
+{
+  if (!getenv("POSEIDON_RUSAGE") || length < RESULT_SIZE)
+    return;
+  fprintf(stderr, "pyseidon: status=%d signal=%d wall=%.3fs cpu=%.3fs maxrss=%llukB\n",
+	  unpack_int(result), unpack_int(result + 4),
+	  unpack_double(result + 8), unpack_double(result + 16),
+	  unpack_u64(result + 24) / 1024);
+}
+
+// A master that doesn't speak our version answers with this status,
+// followed by the versions it does
+#define UNSUPPORTED_PROTOCOL_STATUS 101
+
+void check_protocol(unsigned char *result, size_t length, int version)
+{
+  const char *prefix = "supported=";
+  size_t prefix_len = strlen(prefix);
+  if (length < 4 + prefix_len || unpack_int(result) != UNSUPPORTED_PROTOCOL_STATUS ||
+      memcmp(result + 4, prefix, prefix_len) != 0)
+    return;
+  const char *versions = (const char *)result + 4 + prefix_len;
+  fprintf(stderr, "pyseidon: master does not speak protocol version %d; it supports %.*s\n",
+	  version, (int)strnlen(versions, length - 4 - prefix_len), versions);
+}
+
+// address is host:port
+int connect_tcp(char *address)
+{
+  char *host = strdup(address);
+  if (!host) {
+    handle_error("Could not allocate enough memory to store POSEIDON_TCP");
+  }
+  char *port = strrchr(host, ':');
+  if (!port) {
+    errno = 0;
+    handle_error("POSEIDON_TCP must be host:port");
+  }
+  *port++ = '\0';
+  // [::1]:7000
+  if (host[0] == '[' && host[strlen(host) - 1] == ']') {
+    host[strlen(host) - 1] = '\0';
+    host++;
+  }
+
+  struct addrinfo hints, *addrs, *addr;
+  memset(&hints, 0, sizeof(hints));
+  hints.ai_family = AF_UNSPEC;
+  hints.ai_socktype = SOCK_STREAM;
+  int err;
+  if ((err = getaddrinfo(host, port, &hints, &addrs)) != 0) {
+    errno = 0;
+    fprintf(stderr, "%s\n", gai_strerror(err));
+    handle_error("Could not resolve POSEIDON_TCP");
+  }
+  int s = -1;
+  for (addr = addrs; addr; addr = addr->ai_next) {
+    if ((s = socket(addr->ai_family, addr->ai_socktype, addr->ai_protocol)) < 0)
+      continue;
+    if (connect(s, addr->ai_addr, addr->ai_addrlen) == 0)
+      break;
+    close(s);
+    s = -1;
+  }
+  freeaddrinfo(addrs);
+  if (s >= 0) {
+    int one = 1;
+    setsockopt(s, IPPROTO_TCP, TCP_NODELAY, &one, sizeof(one));
+  }
+  return s;
+}
+
+void write_all(int fd, char *buf, size_t length)
+{
+  while (length > 0) {
+    ssize_t n = write(fd, buf, length);
+    if (n < 0) {
+      if (errno == EINTR)
+        continue;
+      if (errno == EAGAIN) {
+        struct pollfd p = {fd, POLLOUT, 0};
+        poll(&p, 1, -1);
+        continue;
+      }
+      handle_error("Could not write output");
+    }
+    buf += n;
+    length -= n;
+  }
+}
+
+// Relay our stdin to the master, and its frames to our stdout and
+// stderr, until it sends the result. Output is always read, even
+// while stdin is waiting to go out, so a worker that writes before it
+// reads can't wedge us.
+int stream_tcp(int s)
+{
+  char *in, *out;
+  if ((in = (char *)malloc(STREAM_CHUNK)) == NULL || (out = (char *)malloc(FRAME_HEADER + STREAM_CHUNK)) == NULL) {
+    handle_error("Could not allocate enough memory to relay stdio");
+  }
+  size_t out_len = 0, out_pos = 0;
+  int stdin_open = 1;
+  unsigned char header[FRAME_HEADER];
+  size_t header_len = 0, remaining = 0;
+  int type = -1;
+  unsigned char result[RESULT_SIZE];
+  size_t result_len = 0;
+
+  fcntl(s, F_SETFL, fcntl(s, F_GETFL) | O_NONBLOCK);
+  while (1) {
+    struct pollfd fds[2];
+    int nfds = 1;
+    fds[0].fd = s;
+    fds[0].events = POLLIN | (out_pos < out_len ? POLLOUT : 0);
+    if (stdin_open && out_pos == out_len) {
+      fds[1].fd = 0;
+      fds[1].events = POLLIN;
+      nfds = 2;
+    }
+    if (poll(fds, nfds, -1) < 0) {
+      if (errno == EINTR)
+        continue;
+      handle_error("Could not poll");
+    }
+
+    if (nfds == 2 && fds[1].revents) {
+      ssize_t n = read(0, out + FRAME_HEADER, STREAM_CHUNK);
+      if (n < 0 && (errno == EINTR || errno == EAGAIN))
+        continue;
+      if (n <= 0) {
+        // An empty frame tells the worker it's seen all of stdin
+        n = 0;
+        stdin_open = 0;
+      }
+      out[0] = 0;
+      pack_int((unsigned char *)out + 1, n);
+      out_len = FRAME_HEADER + n;
+      out_pos = 0;
+    }
+    if (out_pos < out_len) {
+      ssize_t n = send(s, out + out_pos, out_len - out_pos, MSG_NOSIGNAL);
+      if (n > 0) {
+        out_pos += n;
+      } else if (n < 0 && errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+        // The master's gone; reading will tell us how it went
+        out_pos = out_len = 0;
+        stdin_open = 0;
+      }
+    }
+
+    if (!(fds[0].revents & (POLLIN | POLLHUP | POLLERR)))
+      continue;
+    ssize_t n = recv(s, in, STREAM_CHUNK, 0);
+    if (n < 0) {
+      if (errno == EINTR || errno == EAGAIN)
+        continue;
+      handle_error("Could not receive from master");
+    } else if (n == 0) {
+      errno = 0;
       handle_error("Master hung up connection");
     }
-    total += t;
+    for (ssize_t i = 0; i < n || (type >= 0 && remaining == 0);) {
+      if (type < 0) {
+        header[header_len++] = in[i++];
+        if (header_len == FRAME_HEADER) {
+          type = header[0];
+          remaining = (unsigned int)unpack_int(header + 1);
+          header_len = 0;
+        }
+        continue;
+      }
+      size_t take = MIN(remaining, (size_t)(n - i));
+      if (type == 1 || type == 2) {
+        write_all(type, in + i, take);
+      } else if (type == FRAME_EXIT) {
+        // The status comes first; anything after what we know of is
+        // for newer clients
+        for (size_t j = 0; j < take && result_len < RESULT_SIZE; j++) {
+          result[result_len++] = in[i + j];
+        }
+      } else {
+        errno = 0;
+        handle_error("Master sent a malformed frame");
+      }
+      i += take;
+      remaining -= take;
+      if (remaining == 0) {
+        if (type == FRAME_EXIT) {
+          if (result_len < 4) {
+            errno = 0;
+            handle_error("Master sent a malformed result");
+          }
+          close(s);
+          check_protocol(result, result_len, PROTOCOL_VERSION);
+          print_usage(result, result_len);
+          return unpack_int(result);
+        }
+        type = -1;
+      }
+    }
+  }
+}
+
+double now()
+{
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+pid_t start_master(char *command)
+{
+  pid_t pid = fork();
+  if (pid < 0) {
+    handle_error("Could not fork to start master");
+  } else if (pid == 0) {
+    // Its own session, so it outlives us and our terminal. Its output
+    // goes where handle_error will look for it.
+    setsid();
+    char *errorfile = getenv("POSEIDON_ERRORFILE");
+    int in = open("/dev/null", O_RDONLY);
+    int out = open(errorfile ? errorfile : "/dev/null", O_WRONLY | O_CREAT | O_APPEND, 0600);
+    if (in < 0 || out < 0) {
+      _exit(127);
+    }
+    dup2(in, 0);
+    dup2(out, 1);
+    dup2(out, 2);
+    execl("/bin/sh", "sh", "-c", command, (char *)NULL);
+    _exit(127);
+  }
+  return pid;
+}
+
+// With POSEIDON_MASTER set to a shell command that runs the master, a
+// client that finds nothing listening starts it, and waits (up to
+// POSEIDON_MASTER_TIMEOUT seconds) for it to come up.
+int connect_master(char *sock_path)
+{
+  int s = try_connect(sock_path);
+  char *command = getenv("POSEIDON_MASTER");
+  if (s >= 0 || !command || (errno != ENOENT && errno != ECONNREFUSED)) {
+    return s;
+  }
+
+  double timeout = 120;
+  char *timeout_env = getenv("POSEIDON_MASTER_TIMEOUT");
+  if (timeout_env)
+    timeout = atof(timeout_env);
+
+  // Only one client at a time gets to start a master; the rest wait
+  // for it here, and then find it listening.
+  char *lock_path;
+  if ((lock_path = (char *)malloc(strlen(sock_path) + 6)) == NULL) {
+    handle_error("Could not allocate enough memory to store lock path");
+  }
+  sprintf(lock_path, "%s.lock", sock_path);
+  int lock;
+  if ((lock = open(lock_path, O_RDWR | O_CREAT | O_CLOEXEC, 0600)) < 0) {
+    handle_error("Could not open lock file for starting master");
+  }
+  free(lock_path);
+  if (flock(lock, LOCK_EX) < 0) {
+    handle_error("Could not lock lock file for starting master");
+  }
+
+  s = try_connect(sock_path);
+  if (s < 0 && (errno == ENOENT || errno == ECONNREFUSED)) {
+    if (errno == ECONNREFUSED) {
+      // Left behind by a master that's gone; it'd stop the new one
+      // from binding
+      unlink(sock_path);
+    }
+    pid_t pid = start_master(command);
+    double deadline = now() + timeout;
+    useconds_t delay = 1000;
+    int status;
+    while ((s = try_connect(sock_path)) < 0) {
+      if (errno != ENOENT && errno != ECONNREFUSED) {
+        break;
+      }
+      if (waitpid(pid, &status, WNOHANG) == pid) {
+        errno = 0;
+        fprintf(stderr, "Master exited before it started listening (see POSEIDON_ERRORFILE for its output)\n");
+        break;
+      }
+      if (now() > deadline) {
+        errno = ETIMEDOUT;
+        break;
+      }
+      usleep(delay);
+      if (delay < 100000)
+        delay *= 2;
+    }
+  }
+  close(lock);
+  return s;
+}
+
+int main(int argc, char **argv)
+{
+  char *sock_path = getenv("POSEIDON_SOCK");
+  if (!sock_path)
+    sock_path = "/tmp/pyseidon.sock";
+
+  // Set POSEIDON_PROTOCOL=1 to talk to masters that predate v2
+  int version = PROTOCOL_VERSION;
+  char *protocol = getenv("POSEIDON_PROTOCOL");
+  if (protocol)
+    version = atoi(protocol);
+
+  // Set POSEIDON_TCP=host:port (and POSEIDON_TOKEN) to reach a master
+  // that's listening on TCP
+  char *tcp = getenv("POSEIDON_TCP");
+  char *token = NULL;
+  if (tcp) {
+    token = getenv("POSEIDON_TOKEN");
+    if (!token) {
+      errno = 0;
+      handle_error("POSEIDON_TCP needs POSEIDON_TOKEN to be set too");
+    }
+    // The job gets our environment, but not the key to the master:
+    // keep the token out of what we send along with it
+    if ((token = strdup(token)) == NULL) {
+      handle_error("Could not allocate enough memory to store token");
+    }
+    unsetenv("POSEIDON_TOKEN");
+  }
+
+  int env_size = 0;
+  while (environ[env_size] != NULL) {
+    env_size++;
+  }
+
+  if (tcp) {
+    int s;
+    if ((s = connect_tcp(tcp)) < 0) {
+      handle_error("Could not connect to master over TCP");
+    }
+    char *cwd = get_cwd();
+    send_request_v2(s, argc, argv, env_size, cwd, token);
+    free(cwd);
+    return stream_tcp(s);
+  }
+
+  int s;
+  if ((s = connect_master(sock_path)) < 0) {
+    handle_error("Could not connect to UNIX socket for master process");
+  }
+
+  char *cwd = get_cwd();
+  if (version == 1) {
+    send_request_v1(s, argc, argv, env_size, cwd);
+  } else {
+    send_request_v2(s, argc, argv, env_size, cwd, NULL);
+  }
+  free(cwd);
+
+  unsigned char exitstatus[4];
+  if (version == 1) {
+    checked_recv(s, exitstatus, 4);
+  } else {
+    // v2 results are length-prefixed, with the exit status first
+    unsigned char header[4];
+    checked_recv(s, header, 4);
+    int length = unpack_int(header);
+    if (length < 4) {
+      handle_error("Master sent a malformed result");
+    }
+    unsigned char *result;
+    if ((result = (unsigned char *)malloc(length)) == NULL) {
+      handle_error("Could not allocate enough memory to store result");
+    }
+    checked_recv(s, result, length);
+    memcpy(exitstatus, result, 4);
+    check_protocol(result, length, version);
+    print_usage(result, length);
+    free(result);
   }
 
   close(s);
@@ -1,8 +1,101 @@
+import dis
+import functools
+import hashlib
+import importlib
+import importlib.util
+import marshal
+import os
 import pyseidon
+import struct
 import sys
+import tempfile
+import types
 
-def handle_script():
-    import runpy
+# Python's own magic number, so files from another version are ignored;
+# then the script's mtime (in ns) and size.
+_HEADER = struct.Struct('<4sQQ')
+
+def _default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pyseidon', 'code')
+
+class CodeCache(object):
+    """Compiled scripts by path, validated by mtime and size.
+
+    Code objects are kept in memory, where workers forked later
+    inherit them, and as marshal files under directory, so they
+    survive the master restarting.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or _default_cache_dir()
+        self.entries = {}
+
+    def get(self, path):
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        code = self._load(path, stamp)
+        if code is None:
+            with open(path, 'rb') as f:
+                source = f.read()
+            code = compile(source, path, 'exec', dont_inherit=True)
+            self._store(path, stamp, code)
+        self.entries[path] = (stamp, code)
+        return code
+
+    def _cache_file(self, path):
+        return os.path.join(self.directory, hashlib.sha1(os.fsencode(path)).hexdigest() + '.pyc')
+
+    def _load(self, path, stamp):
+        try:
+            with open(self._cache_file(path), 'rb') as f:
+                data = f.read()
+            magic, mtime, size = _HEADER.unpack_from(data)
+            if magic != importlib.util.MAGIC_NUMBER or (mtime, size) != stamp:
+                return None
+            return marshal.loads(data[_HEADER.size:])
+        except (IOError, OSError, struct.error, EOFError, ValueError, TypeError):
+            return None
+
+    def _store(self, path, stamp, code):
+        # Write and rename, so nobody ever reads half a file
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(importlib.util.MAGIC_NUMBER, *stamp))
+                f.write(marshal.dumps(code))
+            os.rename(tmp, self._cache_file(path))
+        except (IOError, OSError) as e:
+            print('[{}] Could not cache compiled code for {}: {}'.format(os.getpid(), path, e), file=sys.stderr)
+
+def imported_modules(code):
+    """Names of the modules a script imports at the top level (that is,
+    outside of any function or class)."""
+    names = []
+    for instruction in dis.get_instructions(code):
+        # Relative imports can't work from a script anyway
+        if instruction.opname == 'IMPORT_NAME' and instruction.argval and instruction.argval not in names:
+            names.append(instruction.argval)
+    return names
+
+def _run_code(code, path):
+    # What runpy.run_path does for a plain script, minus reading and
+    # compiling it
+    main = types.ModuleType('__main__')
+    main.__file__ = path
+    main.__cached__ = None
+    saved = sys.modules['__main__']
+    sys.modules['__main__'] = main
+    try:
+        exec(code, main.__dict__)
+    finally:
+        sys.modules['__main__'] = saved
+
+def handle_script(code_cache=None, preimport=False, **kwargs):
     """
 Allow the client to run an arbitrary Python script.
 
@@ -18,11 +111,66 @@ if __name__ == '__main__':
   import pyseidon.handlers
   pyseidon.handlers.handle_script()
 ```
+
+Compiled scripts are cached (see CodeCache), so workers start running
+bytecode straight away. With preimport, the first time a script is run
+the master also imports the modules it imports at the top level, so
+later workers get them for free. Scripts come from clients, so this
+runs their imports (and whatever code those run) in the master: pass
+preimport=True only if you trust every client, or else a list of
+top-level package names to limit it to. The imports are put off until
+the master is idle (see Pyseidon.defer()). Other keyword arguments are
+passed to run().
 """
+    import runpy
+    if code_cache is None:
+        code_cache = CodeCache()
+    if preimport is True or not preimport:
+        allowed = None
+    else:
+        allowed = frozenset(preimport)
+    preimported = set()
+    master = pyseidon.Pyseidon()
+
     def handler():
         if len(sys.argv) < 1:
-            print >>sys.stderr, 'Must provide path to Python script to execute'
+            print('Must provide path to Python script to execute', file=sys.stderr)
             sys.exit(1)
-        runpy.run_path(sys.argv[0], run_name='__main__')
-    master = pyseidon.Pyseidon()
-    master.run(handler)
+        path = sys.argv[0]
+        if not os.path.isfile(path):
+            # Directories and zipfiles with a __main__.py
+            runpy.run_path(path, run_name='__main__')
+            return
+        code = code_cache.get(path)
+        # Let the master catch up, for the next worker's sake
+        master._report({'type': 'script', 'path': os.path.realpath(path)})
+        _run_code(code, path)
+
+    def on_script(message):
+        path = message['path']
+        try:
+            code = code_cache.get(path)
+        except Exception as e:
+            print('[{}] Could not load script {}: {}'.format(os.getpid(), path, e), file=sys.stderr)
+            return
+        if not preimport or path in preimported:
+            return
+        preimported.add(path)
+        for name in imported_modules(code):
+            if allowed is None or name.partition('.')[0] in allowed:
+                # One module at a time, so a client that turns up in
+                # the meantime waits on at most one import
+                master.defer(functools.partial(preimport_module, name, path))
+
+    def preimport_module(name, path):
+        if name in sys.modules:
+            return
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print('[{}] Could not preimport {} for {}: {}'.format(os.getpid(), name, path, e), file=sys.stderr)
+        else:
+            print('[{}] Preimported {} for {}'.format(os.getpid(), name, path), file=sys.stderr)
+
+    master.report_handlers['script'] = on_script
+    master.run(handler, **kwargs)
@@ -0,0 +1,234 @@
+"""
+Learn which modules workers end up importing for themselves, and
+preload them in the master next time.
+
+Pass an ImportProfile to run(). Workers time every import their
+handler does, and report the modules that weren't already preloaded.
+The master keeps a running record in a JSON file, and imports
+everything in it (that took at least min_seconds) before serving:
+
+```
+import pyseidon
+import pyseidon.imports
+
+pyseidon.Pyseidon().run(handler, import_profile=pyseidon.imports.ImportProfile('/var/tmp/myapp-imports.json'))
+```
+
+The file is plain JSON, so modules that shouldn't be imported in the
+master (say, ones that start threads on import) can be edited out.
+
+BootProfile is for the master's own boot: how long each import and
+setup step took, and how much memory it added.
+"""
+import contextlib
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Save at least this often while workers keep reporting
+_SAVE_INTERVAL = 60
+
+def _rss():
+    # Resident bytes, or None where /proc/self/statm isn't available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+class _TimedLoader(object):
+    def __init__(self, loader, seconds, memory):
+        self.loader = loader
+        self.seconds = seconds
+        self.memory = memory
+
+    def create_module(self, spec):
+        create = getattr(self.loader, 'create_module', None)
+        return create(spec) if create is not None else None
+
+    def exec_module(self, module):
+        # Don't leave ourselves behind on the module
+        module.__loader__ = self.loader
+        if getattr(module, '__spec__', None) is not None:
+            module.__spec__.loader = self.loader
+        rss = _rss() if self.memory is not None else None
+        start = time.monotonic()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            # Includes the time spent importing its own imports
+            self.seconds[module.__name__] = time.monotonic() - start
+            if rss is not None:
+                self.memory[module.__name__] = _rss() - rss
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+class ImportTimer(object):
+    """Meta path finder timing every import that goes past it. With
+    memory, it also records how much each grew the resident set."""
+    def __init__(self, memory=False):
+        self.seconds = {}
+        self.memory = {} if memory else None
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self:
+                continue
+            find_spec = getattr(finder, 'find_spec', None)
+            if find_spec is None:
+                continue
+            spec = find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, self.seconds, self.memory)
+        return spec
+
+    def new_modules(self, before):
+        """Return {name: seconds} for modules imported since before (a
+        set of module names) that are still around."""
+        return {
+            name: self.seconds.get(name, 0.0)
+            for name in list(sys.modules)
+            if name not in before and name != '__main__'
+        }
+
+class ImportProfile(object):
+    """Modules workers imported after the fork, with the worst time
+    seen for each and how many workers imported them, kept in a JSON
+    file at path."""
+    def __init__(self, path, min_seconds=0.001):
+        self.path = path
+        self.min_seconds = min_seconds
+        self.modules = {}
+        self.saved_at = 0
+        try:
+            with open(path) as f:
+                self.modules = json.load(f)['modules']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def for_profile(self, name):
+        """The same settings, recorded separately for a named profile."""
+        root, ext = os.path.splitext(self.path)
+        return ImportProfile('{}-{}{}'.format(root, name, ext), min_seconds=self.min_seconds)
+
+    def record(self, modules):
+        """Merge in one worker's report, saving if it's news."""
+        new = False
+        for name, seconds in modules.items():
+            entry = self.modules.get(name)
+            if entry is None:
+                entry = self.modules[name] = {'seconds': 0.0, 'workers': 0}
+                new = True
+            entry['seconds'] = max(entry['seconds'], seconds)
+            entry['workers'] += 1
+        if new or time.time() - self.saved_at >= _SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        # Write and rename, so a crash never leaves half a file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.pyseidon-imports-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'modules': self.modules}, f, indent=2, sort_keys=True)
+            os.rename(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.saved_at = time.time()
+
+    def preload(self):
+        """Import every recorded module that's slow enough to be worth
+        it. Returns (imported, failed, seconds)."""
+        start = time.monotonic()
+        imported, failed = [], []
+        for name in sorted(self.modules):
+            if name in sys.modules or self.modules[name]['seconds'] < self.min_seconds:
+                continue
+            try:
+                importlib.import_module(name)
+            except Exception as e:
+                # Not worth failing the boot over
+                print('[{}] Could not preload {}: {}'.format(os.getpid(), name, e), file=sys.stderr)
+                failed.append(name)
+            else:
+                imported.append(name)
+        return imported, failed, time.monotonic() - start
+
+class BootProfile(object):
+    """Records what the master's boot costs: each import, with its time
+    and the memory it added, and each setup step wrapped in step().
+    Create it first thing (imports before that aren't seen) and pass
+    it to run(), which adds its own steps and writes the lot as JSON to
+    path before serving:
+
+    ```
+    import pyseidon.imports
+    boot = pyseidon.imports.BootProfile('/var/tmp/myapp-boot.json')
+
+    import myapp
+    with boot.step('load model'):
+        MODEL = myapp.load_model()
+
+    pyseidon.Pyseidon().run(handler, boot_profile=boot)
+    ```
+
+    An import's figures include those of the imports it did itself.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.started_at = time.monotonic()
+        self.start_rss = _rss()
+        self.preloaded = set(sys.modules)
+        self.steps = []
+        self.timer = ImportTimer(memory=True)
+        self.timer.install()
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """Time the enclosed block as a setup step called name."""
+        rss = _rss()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.steps.append({
+                'name': name,
+                'seconds': time.monotonic() - start,
+                'rss_bytes': None if rss is None else _rss() - rss,
+            })
+
+    def save(self):
+        """Stop recording, and write out what was recorded."""
+        self.timer.uninstall()
+        imports = [
+            {'name': name, 'seconds': seconds, 'rss_bytes': self.timer.memory.get(name)}
+            for name, seconds in self.timer.new_modules(self.preloaded).items()
+        ]
+        imports.sort(key=lambda entry: entry['seconds'], reverse=True)
+        rss = _rss()
+        report = {
+            'seconds': time.monotonic() - self.started_at,
+            'rss_bytes': rss,
+            'rss_growth_bytes': None if rss is None or self.start_rss is None else rss - self.start_rss,
+            'steps': self.steps,
+            'imports': imports,
+        }
+        with open(self.path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('[{}] Boot took {:.2f}s; wrote profile to {}'.format(os.getpid(), report['seconds'], self.path), file=sys.stderr)
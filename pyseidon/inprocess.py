@@ -0,0 +1,174 @@
+"""
+Run handlers inside the master, on a thread, instead of in a forked
+worker.
+
+Only for handlers that are cheap and touch no shared state: a handler
+running in-process shares the master's memory, and a crash or a hang
+takes the master with it. Declare one safe with in_process() and pass
+threads to run():
+
+```
+import pyseidon
+
+@pyseidon.in_process
+def handler():
+  print(' '.join(sys.argv))
+
+pyseidon.Pyseidon().run(handler, threads=8)
+```
+
+Each request gets its own sys.argv, os.environ, sys.stdin, sys.stdout
+and sys.stderr, which are swapped for proxies to the current request's
+while serving. The working directory is shared by the whole process,
+so it's left alone; use current_request()['cwd'] instead.
+
+The proxy for os.environ only exists in Python: the process's own
+environment stays the master's. Subprocesses inherit that one, so
+pass the request's along explicitly:
+
+```
+subprocess.run(cmd, env=dict(os.environ), cwd=pyseidon.inprocess.current_request()['cwd'])
+```
+"""
+import collections.abc
+import os
+import sys
+import threading
+import traceback
+
+_local = threading.local()
+
+def in_process(handler):
+    """Mark handler as safe to run on a thread in the master."""
+    handler.pyseidon_in_process = True
+    return handler
+
+def is_in_process(handler):
+    return getattr(handler, 'pyseidon_in_process', False)
+
+def current_request():
+    """The request being served on this thread (a dict of argv, env,
+    cwd, stdin, stdout and stderr), or None."""
+    return getattr(_local, 'request', None)
+
+class _StreamProxy(object):
+    def __init__(self, name, default):
+        self._name = name
+        self._default = default
+
+    def _target(self):
+        request = current_request()
+        return self._default if request is None else request[self._name]
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __iter__(self):
+        return iter(self._target())
+
+class _ArgvProxy(collections.abc.MutableSequence):
+    def __init__(self, default):
+        self._default = default
+
+    def _target(self):
+        request = current_request()
+        return self._default if request is None else request['argv']
+
+    def __getitem__(self, index):
+        return self._target()[index]
+
+    def __setitem__(self, index, value):
+        self._target()[index] = value
+
+    def __delitem__(self, index):
+        del self._target()[index]
+
+    def __len__(self):
+        return len(self._target())
+
+    def insert(self, index, value):
+        self._target().insert(index, value)
+
+    def __eq__(self, other):
+        return list(self._target()) == other
+
+    def __repr__(self):
+        return repr(self._target())
+
+class _EnvironProxy(collections.abc.MutableMapping):
+    def __init__(self, default):
+        self._default = default
+
+    def _target(self):
+        request = current_request()
+        return self._default if request is None else request['env']
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __delitem__(self, key):
+        del self._target()[key]
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self):
+        return len(self._target())
+
+    def copy(self):
+        return dict(self._target())
+
+    def __repr__(self):
+        return repr(self._target())
+
+def install():
+    """Swap in the per-request proxies. Outside of a request, they pass
+    straight through to what was there before."""
+    if isinstance(sys.stdout, _StreamProxy):
+        return
+    sys.stdin = _StreamProxy('stdin', sys.stdin)
+    sys.stdout = _StreamProxy('stdout', sys.stdout)
+    sys.stderr = _StreamProxy('stderr', sys.stderr)
+    sys.argv = _ArgvProxy(sys.argv)
+    os.environ = _EnvironProxy(os.environ)
+
+def run(handler, request, fds, exit_status):
+    """Serve one request on the current thread, and return its exit
+    status. fds are the client's stdin, stdout and stderr, and are
+    closed when done."""
+    streams = [
+        os.fdopen(fds[0], 'r'),
+        os.fdopen(fds[1], 'w'),
+        os.fdopen(fds[2], 'w'),
+    ]
+    _local.request = {
+        'argv': [a.decode('utf-8') for a in request['argv'][1:]],
+        'env': {k.decode('utf-8'): v.decode('utf-8') for k, v in request['env'].items()},
+        'cwd': request['cwd'].decode('utf-8'),
+        'stdin': streams[0],
+        'stdout': streams[1],
+        'stderr': streams[2],
+    }
+    status = 0
+    try:
+        handler()
+    except SystemExit as e:
+        # As the interpreter would have it
+        if e.code is not None and not isinstance(e.code, int):
+            print(e.code, file=streams[2])
+        status = exit_status(e.code)
+    except BaseException:
+        traceback.print_exc(file=streams[2])
+        status = 1
+    finally:
+        del _local.request
+        for stream in streams:
+            try:
+                stream.close()
+            except (IOError, OSError):
+                # Client went away
+                pass
+    return status
@@ -0,0 +1,277 @@
+"""
+Fan work out from a worker across siblings forked from the master.
+
+multiprocessing in a worker forks the worker, with whatever the
+handler has done to it since. pyseidon.map has the master fork the
+siblings instead, so they start from the same warm, shared state the
+worker did:
+
+```
+import pyseidon
+
+def score(row):
+  return MODEL.predict(row)  # MODEL was loaded before run()
+
+def handler():
+  for score in pyseidon.map(score, ROWS, workers=8):
+    print(score)
+```
+
+Items go to the siblings in chunks and results come back in order, as
+an iterator, like the built-in map. fn is pickled by reference, so it
+has to be importable (at the top level of a module the master has
+loaded). Siblings run with the worker's argv, environment, working
+directory, stdout and stderr, and under its limits.
+
+Siblings count against the master's max_workers and
+min_available_memory. The master forks as many as there's room for,
+and if that's none, the worker does the work itself.
+"""
+import builtins
+import itertools
+import os
+import pickle
+import selectors
+import socket
+import struct
+import sys
+import traceback
+
+# Set in workers (and siblings) to the Pyseidon whose master can fork
+# siblings for them
+master = None
+
+_LENGTH = struct.Struct('<I')
+# What a sibling sends first, once it's up. A channel the master
+# closes without forking for it never gets one.
+_READY = b'R'
+# Chunks each sibling has queued up, so none of them sits idle waiting
+# for the next
+_CHUNKS_IN_FLIGHT = 2
+
+class RemoteTraceback(Exception):
+    """The traceback of an exception raised by fn in a sibling, attached
+    as its cause."""
+    def __init__(self, tb):
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+def _frame(obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return _LENGTH.pack(len(data)) + data
+
+def _default_chunksize(items, workers):
+    try:
+        n = len(items)
+    except TypeError:
+        return 1
+    # As multiprocessing.Pool.map does it
+    chunksize, extra = divmod(n, workers * 4)
+    return chunksize + 1 if extra else max(chunksize, 1)
+
+def map(fn, items, workers=None, chunksize=None):
+    """Return an iterator over fn applied to each of items, computed by
+    workers siblings (by default, one per CPU). Outside of a forked
+    worker, there's no master to ask, so this is just the built-in
+    map."""
+    if master is None:
+        return builtins.map(fn, items)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = _default_chunksize(items, workers)
+    # Fail here, rather than in every sibling, if fn can't be sent
+    setup = _frame({'fn': fn, 'argv': sys.argv, 'env': dict(os.environ), 'cwd': os.getcwd()})
+    return _map(fn, setup, iter(items), workers, chunksize)
+
+def _chunks(items, chunksize):
+    while True:
+        chunk = list(itertools.islice(items, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def _await_siblings(siblings):
+    # Block until every sibling is up or turned down, and return the
+    # ones that are up
+    selector = selectors.DefaultSelector()
+    for sibling in siblings:
+        selector.register(sibling['sock'], selectors.EVENT_READ, sibling)
+    ready = []
+    try:
+        while selector.get_map():
+            for key, _ in selector.select():
+                sibling = key.data
+                try:
+                    data = sibling['sock'].recv(len(_READY))
+                except BlockingIOError:
+                    continue
+                except ConnectionResetError:
+                    data = b''
+                selector.unregister(sibling['sock'])
+                if data == _READY:
+                    ready.append(sibling)
+                else:
+                    sibling['sock'].close()
+    finally:
+        selector.close()
+    return ready
+
+def _map(fn, setup, items, workers, chunksize):
+    siblings = []
+    theirs = []
+    for _ in range(workers):
+        ours, their = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        ours.setblocking(False)
+        siblings.append({'sock': ours, 'out': bytearray(setup), 'in': bytearray(), 'in_flight': 0, 'done': False, 'exited': False})
+        theirs.append(their)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        master._report({'type': 'map', 'pid': os.getpid()}, [1, 2] + [their.fileno() for their in theirs])
+    finally:
+        # If that didn't get through, we'll see them hang up
+        for their in theirs:
+            their.close()
+
+    siblings = _await_siblings(siblings)
+    if not siblings:
+        # No room in the master for any
+        for value in builtins.map(fn, items):
+            yield value
+        return
+    selector = selectors.DefaultSelector()
+    for sibling in siblings:
+        selector.register(sibling['sock'], selectors.EVENT_READ | selectors.EVENT_WRITE, sibling)
+    chunks = enumerate(_chunks(items, chunksize))
+    exhausted = False
+    sent = 0
+    received = {}
+    following = 0
+    try:
+        while not exhausted or following < sent:
+            # Keep every sibling busy
+            for sibling in siblings:
+                if sibling['exited']:
+                    continue
+                while not exhausted and sibling['in_flight'] < _CHUNKS_IN_FLIGHT:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    sibling['out'] += _frame(chunk)
+                    sibling['in_flight'] += 1
+                    sent += 1
+                events = selectors.EVENT_READ
+                if sibling['out']:
+                    events |= selectors.EVENT_WRITE
+                elif exhausted and not sibling['done']:
+                    # Nothing more is coming; it exits once it's done
+                    sibling['sock'].shutdown(socket.SHUT_WR)
+                    sibling['done'] = True
+                selector.modify(sibling['sock'], events, sibling)
+
+            for key, mask in selector.select():
+                sibling = key.data
+                if mask & selectors.EVENT_WRITE:
+                    try:
+                        del sibling['out'][:sibling['sock'].send(sibling['out'])]
+                    except BlockingIOError:
+                        pass
+                    except (BrokenPipeError, ConnectionResetError):
+                        raise RuntimeError('A pyseidon.map sibling died')
+                if mask & selectors.EVENT_READ:
+                    _read_results(selector, sibling, received)
+
+            # Hand back whatever's next in order
+            while following in received:
+                ok, values = received.pop(following)
+                following += 1
+                if not ok:
+                    exc, tb = values
+                    raise exc from RemoteTraceback(tb)
+                for value in values:
+                    yield value
+    finally:
+        # Closing early makes the siblings exit, too
+        selector.close()
+        for sibling in siblings:
+            sibling['sock'].close()
+
+def _read_results(selector, sibling, received):
+    try:
+        data = sibling['sock'].recv(65536)
+    except BlockingIOError:
+        return
+    except ConnectionResetError:
+        data = b''
+    if not data:
+        if sibling['in_flight']:
+            raise RuntimeError('A pyseidon.map sibling died')
+        sibling['exited'] = True
+        selector.unregister(sibling['sock'])
+        return
+    buf = sibling['in']
+    buf += data
+    while len(buf) >= _LENGTH.size:
+        length, = _LENGTH.unpack_from(buf)
+        if len(buf) < _LENGTH.size + length:
+            break
+        index, ok, values = pickle.loads(buf[_LENGTH.size:_LENGTH.size + length])
+        del buf[:_LENGTH.size + length]
+        received[index] = (ok, values)
+        sibling['in_flight'] -= 1
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        data = sock.recv(n - len(buf))
+        if not data:
+            return None
+        buf += data
+    return buf
+
+def _read_frame(sock):
+    header = _recv_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, _LENGTH.unpack(header)[0])
+    return None if data is None else pickle.loads(data)
+
+def serve(channel, stdio, limits=None):
+    """Sibling side: apply fn to chunks from the worker on channel until
+    it hangs up. limits are the worker's (see Pyseidon.run)."""
+    sock = socket.socket(fileno=channel)
+    if limits:
+        master._apply_limits(limits)
+    sock.sendall(_READY)
+    setup = _read_frame(sock)
+    if setup is None:
+        return
+    fn = setup['fn']
+    sys.argv = setup['argv']
+    os.environ.clear()
+    os.environ.update(setup['env'])
+    os.chdir(setup['cwd'])
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    for fd, target in zip([devnull] + stdio, (0, 1, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+    while True:
+        chunk = _read_frame(sock)
+        if chunk is None:
+            break
+        index, items = chunk
+        try:
+            reply = _frame((index, True, [fn(item) for item in items]))
+        except Exception as e:
+            tb = traceback.format_exc()
+            try:
+                reply = _frame((index, False, (e, tb)))
+            except Exception:
+                # Can't pickle the exception (or it was the result that
+                # couldn't be)
+                reply = _frame((index, False, (RuntimeError('{}: {}'.format(type(e).__name__, e)), tb)))
+        sock.sendall(reply)
@@ -0,0 +1,126 @@
+"""
+Share large datasets with workers without them drifting into private
+memory.
+
+Blobs registered here live in their own memory mappings rather than in
+Python objects, so nothing a worker does (refcounting, garbage
+collection, the allocator) ever writes to their pages. Register data in
+the master before calling run(), and fetch read-only views by name from
+the workers:
+
+```
+import pyseidon
+import pyseidon.preload
+
+pyseidon.preload.add_file('weights', '/data/weights.bin')
+pyseidon.preload.add_array('embeddings', load_embeddings())
+
+def handler():
+  weights = pyseidon.preload.get('weights')
+  embeddings = pyseidon.preload.get_array('embeddings')
+  ...
+
+pyseidon.Pyseidon().run(handler)
+```
+"""
+import mmap
+import os
+import struct
+
+_registry = {}
+
+def _register(name, mapping, size, format='B', shape=None, dtype=None, offset=0):
+    # Several objects can share a mapping (say, a snapshot's), each at
+    # its own offset
+    if name in _registry:
+        raise KeyError('Preloaded object already registered: {}'.format(name))
+    if shape is None:
+        # Flat, in items of format
+        try:
+            itemsize = struct.calcsize(format)
+        except struct.error:
+            raise ValueError('Unsupported format: {!r}'.format(format))
+        if size % itemsize:
+            raise ValueError('{} is {} bytes, not a whole number of {!r} items'.format(name, size, format))
+        shape = (size // itemsize,)
+    _registry[name] = {
+        'mmap': mapping,
+        'offset': offset,
+        'size': size,
+        'format': format,
+        'shape': shape,
+        'dtype': dtype,
+    }
+
+def _anonymous_copy(view):
+    size = view.nbytes
+    # mmap can't map zero bytes. Private, so the pages stay shared
+    # after fork only until someone writes to them: a worker that
+    # scribbles on its copy never changes anyone else's.
+    mapping = mmap.mmap(-1, max(size, 1), flags=mmap.MAP_PRIVATE, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+    if size:
+        mapping[:size] = view.cast('B') if view.c_contiguous else view.tobytes()
+    return mapping
+
+def add_bytes(name, data):
+    """Copy a bytes-like object into a shared mapping, under name."""
+    view = memoryview(data)
+    _register(name, _anonymous_copy(view), view.nbytes)
+
+def add_array(name, array):
+    """Copy any buffer (array.array, NumPy array, ...) into a shared
+    mapping, keeping its element format and shape."""
+    view = memoryview(array)
+    dtype = getattr(array, 'dtype', None)
+    _register(name, _anonymous_copy(view), view.nbytes, format=view.format, shape=view.shape, dtype=dtype)
+
+def add_file(name, path, format='B', shape=None):
+    """Map a file read-only. Its pages come straight from the page
+    cache, so they're also shared with anything else reading it.
+    Without a shape, it's a flat array of format items."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            mapping = mmap.mmap(-1, 1, flags=mmap.MAP_PRIVATE)
+        else:
+            mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        _register(name, mapping, size, format=format, shape=shape)
+    except (KeyError, ValueError):
+        mapping.close()
+        raise
+
+def _view(entry):
+    return memoryview(entry['mmap'])[entry['offset']:entry['offset'] + entry['size']].toreadonly()
+
+def get(name):
+    """Return a read-only, zero-copy memoryview of a preloaded object.
+
+    Views of arrays keep their format and shape where memoryview can
+    express them, and are flat bytes otherwise.
+    """
+    entry = _registry[name]
+    view = _view(entry)
+    if entry['format'] == 'B' and len(entry['shape']) == 1:
+        return view
+    try:
+        return view.cast(entry['format'], entry['shape'])
+    except (TypeError, ValueError):
+        # memoryview only casts to native single-character formats
+        return view
+
+def get_array(name):
+    """Return a read-only NumPy array backed by a preloaded object."""
+    import numpy
+    entry = _registry[name]
+    dtype = entry['dtype'] if entry['dtype'] is not None else numpy.dtype(entry['format'])
+    view = _view(entry)
+    return numpy.frombuffer(view, dtype=dtype).reshape(entry['shape'])
+
+def names():
+    return list(_registry)
+
+def remove(name):
+    entry = _registry.pop(name)
+    if not any(other['mmap'] is entry['mmap'] for other in _registry.values()):
+        entry['mmap'].close()
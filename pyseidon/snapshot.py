@@ -0,0 +1,174 @@
+"""
+Keep the master's slow-to-build state on disk, so that restarting the
+master maps it back in instead of building it again.
+
+Put the slow part of setup in a function and pass it to
+load_or_build(), with a key that changes whenever the function's
+result would (a version number, the mtimes of its inputs, ...):
+
+```
+import pyseidon
+import pyseidon.preload
+import pyseidon.snapshot
+
+def build():
+    pyseidon.preload.add_array('embeddings', compute_embeddings())
+    return {'model': train_model(), 'vocab': load_vocab()}
+
+STATE = pyseidon.snapshot.load_or_build('/var/cache/myapp.snapshot', ('v3', os.path.getmtime('/data/corpus')), build)
+
+pyseidon.Pyseidon().run(handler)
+```
+
+The first boot runs build() and saves what it returned, with pickle
+protocol 5. Large buffers (NumPy arrays, say) are kept out of the
+pickle and are page-aligned in the file. The objects build() registers
+with pyseidon.preload are saved as well. Later boots with the same key
+map the file in and unpickle it, with those buffers as views of the
+mapping. Their pages are only read in when touched, and the page cache
+shares them with every worker and every other master. They come back
+read-only. The rest of the state costs as much as unpickling it does.
+"""
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import time
+
+import pyseidon.preload
+
+_MAGIC = b'PSNP'
+_VERSION = 1
+# Magic and version, then the lengths of the key, the preload index
+# and the state's pickle, and how many buffers there are
+_HEADER = struct.Struct('<4sHxxQQQQ')
+# Offset and size of each buffer
+_BUFFER = struct.Struct('<QQ')
+# Buffers start on a boundary mmap can map from
+_ALIGN = mmap.ALLOCATIONGRANULARITY
+# Smaller buffers aren't worth a page of their own
+_MIN_OUT_OF_BAND = 4096
+
+class _Miss(Exception):
+    pass
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def load_or_build(path, key, build):
+    """Return what build() returns: from the snapshot at path, if it was
+    saved under key (anything picklable), or else by calling build()
+    and saving a new snapshot."""
+    key = pickle.dumps(key, protocol=5)
+    start = time.monotonic()
+    try:
+        state = _load(path, key)
+    except _Miss as e:
+        print('[{}] Building snapshot {}: {}'.format(os.getpid(), path, e), file=sys.stderr)
+    else:
+        print('[{}] Loaded snapshot {} in {:.2f}s'.format(os.getpid(), path, time.monotonic() - start), file=sys.stderr)
+        return state
+
+    before = set(pyseidon.preload.names())
+    state = build()
+    added = [name for name in pyseidon.preload.names() if name not in before]
+    try:
+        _save(path, key, state, added)
+    except Exception as e:
+        # We've got it for this boot, at least
+        print('[{}] Could not save snapshot {}: {}'.format(os.getpid(), path, e), file=sys.stderr)
+    else:
+        print('[{}] Saved snapshot {} (built in {:.2f}s)'.format(os.getpid(), path, time.monotonic() - start), file=sys.stderr)
+    return state
+
+def _save(path, key, state, preload):
+    buffers = []
+    def out_of_band(buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # Not contiguous; it has to go in the pickle
+            return True
+        if raw.nbytes < _MIN_OUT_OF_BAND:
+            return True
+        buffers.append(raw)
+        return False
+    data = pickle.dumps(state, protocol=5, buffer_callback=out_of_band)
+
+    index = []
+    for name in preload:
+        entry = pyseidon.preload._registry[name]
+        index.append({
+            'name': name,
+            'format': entry['format'],
+            'shape': entry['shape'],
+            'dtype': entry['dtype'],
+            'buffer': len(buffers),
+        })
+        buffers.append(pyseidon.preload._view(entry))
+    index = pickle.dumps(index, protocol=5)
+
+    header = _HEADER.pack(_MAGIC, _VERSION, len(key), len(index), len(data), len(buffers))
+    offset = _align(len(header) + len(key) + _BUFFER.size * len(buffers) + len(index) + len(data))
+    table = []
+    for buffer in buffers:
+        table.append(_BUFFER.pack(offset, buffer.nbytes))
+        offset = _align(offset + buffer.nbytes)
+
+    # Write and rename, so a crash never leaves half a snapshot
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.pyseidon-snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in [header, key] + table + [index, data]:
+                f.write(chunk)
+            for buffer, entry in zip(buffers, table):
+                f.seek(_BUFFER.unpack(entry)[0])
+                f.write(buffer)
+            # Even if the last buffer is empty
+            f.truncate(offset)
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _load(path, key):
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        raise _Miss('no snapshot yet')
+    with f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            raise _Miss('snapshot is truncated')
+        # Stays open for as long as anything's using it
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapping)
+    magic, version, key_len, index_len, data_len, count = _HEADER.unpack_from(view)
+    if magic != _MAGIC or version != _VERSION:
+        raise _Miss('snapshot is from another version of pyseidon')
+    pos = _HEADER.size
+    if view[pos:pos + key_len] != key:
+        raise _Miss('key has changed')
+    pos += key_len
+
+    if pos + count * _BUFFER.size + index_len + data_len > len(view):
+        raise _Miss('snapshot is truncated')
+    table = [_BUFFER.unpack_from(view, pos + i * _BUFFER.size) for i in range(count)]
+    pos += count * _BUFFER.size
+    if any(offset + size > len(view) for offset, size in table):
+        raise _Miss('snapshot is truncated')
+    buffers = [view[offset:offset + size] for offset, size in table]
+    try:
+        index = pickle.loads(view[pos:pos + index_len])
+        pos += index_len
+        state = pickle.loads(view[pos:pos + data_len], buffers=buffers)
+    except Exception as e:
+        # Say, a class that's since been moved
+        raise _Miss('could not unpickle it: {}'.format(e))
+
+    for entry in index:
+        offset, size = table[entry['buffer']]
+        pyseidon.preload._register(entry['name'], mapping, size, format=entry['format'], shape=entry['shape'], dtype=entry['dtype'], offset=offset)
+    return state
@@ -0,0 +1,84 @@
+import bisect
+import collections
+import json
+
+# Upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Upper bounds, in bytes
+MEMORY_BUCKETS = tuple(2**i * 1024 * 1024 for i in range(0, 16))
+
+class Histogram(object):
+    """Prometheus-style cumulative histogram, plus a window of the
+    most recent samples for percentiles."""
+    def __init__(self, buckets, window=1024):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, p):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': max(self.recent) if self.recent else None,
+        }
+
+class Stats(object):
+    def __init__(self):
+        self.counters = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    def to_json(self):
+        return json.dumps({
+            'counters': self.counters,
+            'gauges': self.gauges,
+            'histograms': {name: h.summary() for name, h in self.histograms.items()},
+        }, indent=2, sort_keys=True) + '\n'
+
+    def to_prometheus(self):
+        lines = []
+        for name, value in self.counters.items():
+            lines.append('# TYPE pyseidon_{} counter'.format(name))
+            lines.append('pyseidon_{} {}'.format(name, value))
+        for name, value in self.gauges.items():
+            lines.append('# TYPE pyseidon_{} gauge'.format(name))
+            lines.append('pyseidon_{} {}'.format(name, value))
+        for name, h in self.histograms.items():
+            lines.append('# TYPE pyseidon_{} histogram'.format(name))
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append('pyseidon_{}_bucket{{le="{}"}} {}'.format(name, bound, cumulative))
+            lines.append('pyseidon_{}_bucket{{le="+Inf"}} {}'.format(name, h.count))
+            lines.append('pyseidon_{}_sum {}'.format(name, h.sum))
+            lines.append('pyseidon_{}_count {}'.format(name, h.count))
+        return '\n'.join(lines) + '\n'
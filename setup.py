@@ -8,6 +8,7 @@ https://github.com/pypa/sampleproject
 # Always prefer setuptools over distutils
 from setuptools import setup, find_packages
 from distutils.command.build import build as DistutilsBuild
+from distutils.command.build_scripts import build_scripts as DistutilsBuildScripts
 # To use a consistent encoding
 from codecs import open
 from os import path
@@ -21,8 +22,20 @@ class Build(DistutilsBuild):
         subprocess.check_call(['make', '-C', 'pyseidon/client'])
         DistutilsBuild.run(self)
 
+class BuildScripts(DistutilsBuildScripts):
+    # The client is a compiled binary, which the stock command would
+    # try to read as a Python script
+    def copy_scripts(self):
+        self.mkpath(self.build_dir)
+        outfiles = []
+        for script in self.scripts:
+            outfile = path.join(self.build_dir, path.basename(script))
+            self.copy_file(script, outfile)
+            outfiles.append(outfile)
+        return outfiles, outfiles
+
 setup(
-    cmdclass={'build': Build},
+    cmdclass={'build': Build, 'build_scripts': BuildScripts},
 
     name='pyseidon',
 
@@ -70,9 +83,9 @@ setup(
     # simple. Or you can use find_packages().
     packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
 
-    # To provide executable scripts, use entry points in preference to the
-    # "scripts" keyword. Entry points provide cross-platform support and allow
-    # pip to create the appropriate form of executable for the target platform.
+    # The client is the natively compiled binary itself (built by make,
+    # above), rather than an entry point: it runs on every invocation,
+    # and shouldn't have to start an interpreter first.
     scripts=['pyseidon/client/pyseidon'],
-    package_data={'pyseidon': ['client/Makefile', 'client/pyseidon.c', 'client/pyseidon-client']}
+    package_data={'pyseidon': ['client/Makefile', 'client/pyseidon.c']}
 )
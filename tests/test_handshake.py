@@ -0,0 +1,247 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+import pyseidon
+
+ARGV = [b'pyseidon', b'a', b'b c']
+ENV = {b'FOO': b'bar', b'EMPTY': b'', b'EQ': b'x=y'}
+CWD = b'/tmp'
+
+def pack_strings(strings):
+    return struct.pack('<I', len(strings)) + b''.join(s + b'\0' for s in strings)
+
+def v1_request():
+    env = [k + b'=' + v for k, v in ENV.items()]
+    # Then three bytes, each carrying one FD
+    return pack_strings(ARGV) + pack_strings(env) + CWD + b'\0' + b'\0\0\0'
+
+def v2_payload(options=(), argv=ARGV):
+    env = [k + b'=' + v for k, v in ENV.items()]
+    return pack_strings(argv) + pack_strings(env) + CWD + b'\0' + b''.join(o + b'\0' for o in options)
+
+def v2_request(options=(), argv=ARGV, version=pyseidon.PROTOCOL_VERSION, payload=None):
+    if payload is None:
+        payload = v2_payload(options, argv)
+    return pyseidon._V2_HEADER.pack(pyseidon.PROTOCOL_MAGIC, version, 0, len(payload)) + payload
+
+def tcp_preamble(token):
+    return struct.pack('<I', len(token)) + token
+
+class HandshakeTest(unittest.TestCase):
+    def setUp(self):
+        self.conn, self.peer = socket.socketpair()
+        self.fds = []
+
+    def tearDown(self):
+        self.conn.close()
+        self.peer.close()
+        for fd in self.fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def new_fds(self, n=3):
+        fds = [os.open(os.devnull, os.O_RDONLY) for _ in range(n)]
+        self.fds.extend(fds)
+        return fds
+
+    def feed_bytewise(self, handshake, data, fds_at=0, fds=None):
+        # One byte at a time, with the FDs arriving along with byte
+        # fds_at; returns the byte it finished on
+        fds = self.new_fds() if fds is None else fds
+        for i in range(len(data)):
+            done = handshake.feed(data[i:i + 1], fds if i == fds_at else [])
+            if done:
+                return i
+        return None
+
+    def check_request(self, handshake, fds):
+        self.assertEqual(handshake.argv, ARGV)
+        self.assertEqual(handshake.env, ENV)
+        self.assertEqual(handshake.cwd, CWD)
+        self.assertEqual(handshake.fds, fds)
+
+    def test_v1_bytewise(self):
+        handshake = pyseidon._Handshake(self.conn)
+        data = v1_request()
+        fds = self.new_fds()
+        # v1 FDs ride on the three bytes at the end
+        first_fd_byte = len(data) - 3
+        for i in range(len(data)):
+            done = handshake.feed(data[i:i + 1], [fds[i - first_fd_byte]] if i >= first_fd_byte else [])
+            self.assertEqual(done, i == len(data) - 1)
+        self.assertEqual(handshake.version, 1)
+        self.check_request(handshake, fds)
+
+    def test_v1_waits_for_fds(self):
+        handshake = pyseidon._Handshake(self.conn)
+        self.assertFalse(handshake.feed(v1_request(), []))
+        fds = self.new_fds()
+        self.assertTrue(handshake.feed(b'', fds))
+        self.check_request(handshake, fds)
+
+    def test_v2_bytewise(self):
+        data = v2_request(options=[b'priority=3', b'novalue'])
+        for fds_at in (0, 5, len(data) - 1):
+            handshake = pyseidon._Handshake(self.conn)
+            fds = self.new_fds()
+            self.assertEqual(self.feed_bytewise(handshake, data, fds_at, fds), len(data) - 1)
+            self.assertEqual(handshake.version, 2)
+            self.assertEqual(handshake.options, {'priority': '3', 'novalue': ''})
+            self.check_request(handshake, fds)
+
+    def test_v2_waits_for_fds(self):
+        handshake = pyseidon._Handshake(self.conn)
+        self.assertFalse(handshake.feed(v2_request(), []))
+        fds = self.new_fds()
+        self.assertTrue(handshake.feed(b'', fds))
+        self.check_request(handshake, fds)
+
+    def test_v2_empty_argv_and_env(self):
+        payload = pack_strings([]) + pack_strings([]) + b'/\0'
+        handshake = pyseidon._Handshake(self.conn)
+        self.assertTrue(handshake.feed(v2_request(payload=payload), self.new_fds()))
+        self.assertEqual((handshake.argv, handshake.env, handshake.cwd), ([], {}, b'/'))
+
+    def test_multiplexed_requests(self):
+        data = v2_request(options=[b'job=1']) + v2_request(options=[b'job=2'])
+        handshake = pyseidon._Handshake(self.conn)
+        fds = self.new_fds(6)
+        self.assertTrue(handshake.feed(data, fds))
+        self.assertEqual(handshake.options, {'job': '1'})
+        # The next request, and its FDs, are left for the next handshake
+        self.assertEqual(bytes(handshake.buf), v2_request(options=[b'job=2']))
+        self.assertEqual(handshake.fds, fds)
+
+    def assert_rejected(self, data, fds=None, handshake=None, message=None):
+        handshake = handshake or pyseidon._Handshake(self.conn)
+        fds = self.new_fds() if fds is None else fds
+        with self.assertRaises(pyseidon.ProtocolError) as cm:
+            for i in range(len(data)):
+                handshake.feed(data[i:i + 1], fds if i == 0 else [])
+        if message is not None:
+            self.assertIn(message, str(cm.exception))
+
+    def test_rejects_oversized_payload(self):
+        header = pyseidon._V2_HEADER.pack(pyseidon.PROTOCOL_MAGIC, pyseidon.PROTOCOL_VERSION, 0, pyseidon._MAX_PAYLOAD + 1)
+        self.assert_rejected(header, message='too large')
+
+    def test_rejects_counts_past_the_payload(self):
+        payload = struct.pack('<I', 2**32 - 1) + b'a\0'
+        self.assert_rejected(v2_request(payload=payload), message='Truncated')
+
+    def test_rejects_truncated_env(self):
+        payload = pack_strings([b'pyseidon']) + struct.pack('<I', 1) + b'FOO=bar'
+        self.assert_rejected(v2_request(payload=payload), message='Truncated')
+
+    def test_rejects_env_without_equals(self):
+        payload = pack_strings([b'pyseidon']) + pack_strings([b'FOO']) + b'/\0'
+        self.assert_rejected(v2_request(payload=payload), message='missing "="')
+
+    def test_rejects_unsupported_version(self):
+        self.assert_rejected(v2_request(version=3), message='Unsupported protocol version')
+
+    def test_rejects_extra_fds(self):
+        self.assert_rejected(v2_request(), fds=self.new_fds(4), message='three FDs')
+
+    def test_rejects_trailing_data(self):
+        self.assert_rejected(v2_request() + b'x', message='trailing data')
+
+    def test_tcp(self):
+        data = tcp_preamble(b'sekrit') + v2_request() + b'stdin'
+        handshake = pyseidon._Handshake(self.conn, tcp_token=b'sekrit')
+        self.assertEqual(self.feed_bytewise(handshake, data, fds=[]), len(data) - len(b'stdin') - 1)
+        self.assertEqual(handshake.argv, ARGV)
+        # Whatever follows is the client's stdin
+        handshake.feed(b'stdin', [])
+        self.assertEqual(bytes(handshake.buf), b'stdin')
+
+    def test_tcp_rejects_bad_tokens(self):
+        for token in (b'wrong', b'', b'sekrit2'):
+            handshake = pyseidon._Handshake(self.conn, tcp_token=b'sekrit')
+            self.assert_rejected(tcp_preamble(token) + v2_request(), fds=[], handshake=handshake, message='Bad token')
+        handshake = pyseidon._Handshake(self.conn, tcp_token=b'sekrit')
+        # Refused as soon as the length is in
+        self.assert_rejected(struct.pack('<I', pyseidon._MAX_TOKEN + 1), fds=[], handshake=handshake, message='Token too long')
+
+    def test_tcp_rejects_v1_and_jobs(self):
+        handshake = pyseidon._Handshake(self.conn, tcp_token=b't')
+        self.assert_rejected(tcp_preamble(b't') + v1_request(), fds=[], handshake=handshake, message='v2')
+        handshake = pyseidon._Handshake(self.conn, tcp_token=b't')
+        self.assert_rejected(tcp_preamble(b't') + v2_request(options=[b'job=1']), fds=[], handshake=handshake, message='multiplexed')
+
+class MasterHandshakeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.master = pyseidon.Pyseidon(path=os.path.join(self.tmp, 'pyseidon.sock'))
+        self.conn, self.client = socket.socketpair()
+        self.conn.setblocking(False)
+        self.master.handshakes[self.conn] = pyseidon._Handshake(self.conn)
+        self.master._add_reader(self.conn, self.master._continue_handshake)
+
+    def tearDown(self):
+        self.client.close()
+        self.master.report_reader.close()
+        self.master.report_writer.close()
+        shutil.rmtree(self.tmp)
+
+    def test_eof_mid_frame(self):
+        self.client.sendall(v2_request()[:20])
+        self.master._continue_handshake(self.conn)
+        self.assertIn(self.conn, self.master.handshakes)
+        self.client.close()
+        self.master._continue_handshake(self.conn)
+        self.assertNotIn(self.conn, self.master.handshakes)
+        self.assertEqual(self.conn.fileno(), -1)
+
+    def test_bad_frame_is_dropped(self):
+        self.client.sendall(pyseidon._V2_HEADER.pack(pyseidon.PROTOCOL_MAGIC, pyseidon.PROTOCOL_VERSION, 0, pyseidon._MAX_PAYLOAD + 1))
+        self.master._continue_handshake(self.conn)
+        self.assertNotIn(self.conn, self.master.handshakes)
+        # No result, just a hang-up
+        self.assertEqual(self.client.recv(1024), b'')
+
+    def read_refusal(self, length_format):
+        header = struct.Struct(length_format)
+        data = b''
+        while True:
+            chunk = self.client.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        length = header.unpack_from(data)[-1]
+        self.assertEqual(len(data), header.size + length)
+        status, = struct.unpack_from('<i', data, header.size)
+        return status, data[header.size + 4:]
+
+    def test_unsupported_version_is_answered(self):
+        self.client.sendall(v2_request(version=3))
+        self.master._continue_handshake(self.conn)
+        self.assertNotIn(self.conn, self.master.handshakes)
+        status, versions = self.read_refusal('<I')
+        self.assertEqual(status, pyseidon.UNSUPPORTED_PROTOCOL_STATUS)
+        self.assertEqual(versions, b'supported=1,2\0')
+
+    def test_tcp_v1_is_answered(self):
+        self.master.handshakes[self.conn] = pyseidon._Handshake(self.conn, tcp_token=b't')
+        self.client.sendall(tcp_preamble(b't') + v1_request())
+        self.master._continue_handshake(self.conn)
+        self.assertNotIn(self.conn, self.master.handshakes)
+        # Over TCP, the result comes in an exit frame
+        status, versions = self.read_refusal('<BI')
+        self.assertEqual(status, pyseidon.UNSUPPORTED_PROTOCOL_STATUS)
+        self.assertEqual(versions, b'supported=2\0')
+
+    def test_bad_token_is_not_answered(self):
+        self.master.handshakes[self.conn] = pyseidon._Handshake(self.conn, tcp_token=b't')
+        self.client.sendall(tcp_preamble(b'wrong') + v2_request(version=3))
+        self.master._continue_handshake(self.conn)
+        self.assertEqual(self.client.recv(1024), b'')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import array
+import os
+import unittest
+
+import pyseidon.preload
+
+class PreloadTest(unittest.TestCase):
+    def tearDown(self):
+        for entry in pyseidon.preload._registry.values():
+            entry['mmap'].close()
+        pyseidon.preload._registry.clear()
+
+    def test_copies_are_private_to_each_process(self):
+        pyseidon.preload.add_bytes('greeting', b'hello world')
+        pid = os.fork()
+        if pid == 0:
+            # Going around the read-only view, as a stray write might
+            mapping = pyseidon.preload._registry['greeting']['mmap']
+            mapping[:5] = b'HELLO'
+            os._exit(0 if bytes(pyseidon.preload.get('greeting')) == b'HELLO world' else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(bytes(pyseidon.preload.get('greeting')), b'hello world')
+
+    def test_array_keeps_format(self):
+        pyseidon.preload.add_array('numbers', array.array('d', [1.0, 2.5]))
+        view = pyseidon.preload.get('numbers')
+        self.assertTrue(view.readonly)
+        self.assertEqual(view.format, 'd')
+        self.assertEqual(view.tolist(), [1.0, 2.5])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pyseidon
+import pyseidon.imports
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.master = pyseidon.Pyseidon(path=os.path.join(self.tmp, 'pyseidon.sock'))
+        self.master.import_profile = pyseidon.imports.ImportProfile(os.path.join(self.tmp, 'imports.json'))
+
+    def tearDown(self):
+        self.master.report_reader.close()
+        self.master.report_writer.close()
+        shutil.rmtree(self.tmp)
+
+    def test_large_imports_report(self):
+        # Far more than fits in one datagram
+        modules = {'package_{}.module_{}'.format(i // 100, i): 0.01 for i in range(5000)}
+        # Too quick to be worth preloading, so never sent
+        modules['quick'] = 0.0
+        self.master._report_imports(modules)
+        self.master._read_reports(self.master.report_reader)
+        self.assertEqual(len(self.master.import_profile.modules), 5000)
+        self.assertNotIn('quick', self.master.import_profile.modules)
+
+    def test_bad_reports_are_dropped(self):
+        self.master.report_writer.send(b'{"type": "imports", "mod')
+        self.master.report_writer.send(b'[1, 2]')
+        self.master.report_writer.send(b'\xff')
+        # Truncated on the way in
+        self.master.report_writer.send(b' ' * (pyseidon._RECVSIZE + 1))
+        self.master._report({'type': 'imports', 'modules': {'after': 0.01}})
+        self.master._read_reports(self.master.report_reader)
+        self.assertEqual(list(self.master.import_profile.modules), ['after'])
+
+if __name__ == '__main__':
+    unittest.main()